@@ -1,5 +1,21 @@
+import requests
+from requests.adapters import HTTPAdapter
 from simple_salesforce import Salesforce
 
+HTTP_POOL_SIZE = 32  # keep-alive connections per host, sized for the scripts' thread pools
+HTTP_MAX_RETRIES = 3  # connection-level retries (DNS/connect/reset), not HTTP status codes
+
+def build_session():
+    """Return a requests.Session with a pooled, keep-alive HTTPS adapter."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=HTTP_MAX_RETRIES
+    )
+    session.mount("https://", adapter)
+    return session
+
 def connect_salesforce(config):
     """Connects to Salesforce and returns the Salesforce object."""
     return Salesforce(
@@ -7,5 +23,6 @@ def connect_salesforce(config):
         password=config["password"],
         security_token=config["security_token"],
         domain=config["domain"],
-        version='61.0'
+        version='61.0',
+        session=build_session()
     )
@@ -12,17 +12,20 @@ Purpose:
 
 import os
 import csv
+import json
 import math
-import base64
 import logging
-import re
-import requests
+import random
+import tempfile
+import time
+import uuid
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from simple_salesforce import Salesforce
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from mappings import FILES_DIR
+from mappings import soql_list, query_in_chunks, FILES_DIR
 
 INPUT_MAPPING_FILE = os.path.join(FILES_DIR, "contentdocumentlink_mapping.csv")
 OUTPUT_VERSION_MAPPING_FILE = os.path.join(FILES_DIR, "contentversion_migration_mapping.csv")
@@ -40,9 +43,13 @@ CHUNK_SIZE = 200
 API_VERSION = "v59.0"
 MAX_RETRIES = 5
 RETRY_SLEEP_SECS = 2
-REST_MAX_SIZE_BYTES = 50 * 1024 * 1024  # ~50MB REST limit
+RETRY_MAX_SLEEP_SECS = 30
+MULTIPART_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024  # 2GB multipart/form-data ContentVersion limit
+SPOOL_MAX_BYTES = 32 * 1024 * 1024  # upload bodies above this spill from memory to a temp file
+STREAM_CHUNK_BYTES = 1 << 20  # VersionData download read size
+COMPOSITE_BATCH_SIZE = 200  # sObject Collections limit per request
 
-INVALID_FS_CHARS = re.compile(r'[:<>"/\\|?*\x00-\x1F]')
+_FS_TRANS = str.maketrans({c: "_" for c in ':<>"/\\|?*' + "".join(chr(i) for i in range(32))})
 
 def log_and_print(msg, level="info"):
     print(msg)
@@ -78,9 +85,6 @@ def read_mapping_file():
 # -----------------------------
 # SOQL helpers
 # -----------------------------
-def soql_list(ids):
-    return ",".join(f"'{i}'" for i in ids)
-
 def query_all(sf: Salesforce, soql: str):
     attempts = 0
     while True:
@@ -91,8 +95,9 @@ def query_all(sf: Salesforce, soql: str):
             if attempts > MAX_RETRIES:
                 log_and_print(f"[ERROR] SOQL failed after {MAX_RETRIES} attempts: {e}", "error")
                 raise
-            wait = RETRY_SLEEP_SECS * (2 ** (attempts - 1))
-            log_and_print(f"[WARN] SOQL retry {attempts}/{MAX_RETRIES} in {wait}s: {e}", "warning")
+            # Capped exponential backoff; jitter keeps concurrent chunk queries from retrying in lockstep
+            wait = min(RETRY_MAX_SLEEP_SECS, RETRY_SLEEP_SECS * (2 ** (attempts - 1))) * random.uniform(0.5, 1.5)
+            log_and_print(f"[WARN] SOQL retry {attempts}/{MAX_RETRIES} in {wait:.1f}s: {e}", "warning")
             time.sleep(wait)
 
 # -----------------------------
@@ -103,16 +108,15 @@ def fetch_latest_versions(sf: Salesforce, content_doc_ids):
     Returns dict: {ContentDocumentId: ContentVersion record}
       fields: Id, ContentDocumentId, Title, PathOnClient, ContentSize
     """
+    soql = """
+        SELECT Id, ContentDocumentId, Title, PathOnClient, ContentSize
+        FROM ContentVersion
+        WHERE IsLatest = true AND ContentDocumentId IN ({ids})
+    """
+
     out = {}
-    ids = list(set(content_doc_ids))
-    for i in range(0, len(ids), CHUNK_SIZE):
-        chunk = ids[i:i+CHUNK_SIZE]
-        soql = f"""
-            SELECT Id, ContentDocumentId, Title, PathOnClient, ContentSize
-            FROM ContentVersion
-            WHERE IsLatest = true AND ContentDocumentId IN ({soql_list(chunk)})
-        """
-        for r in query_all(sf, soql):
+    for records in query_in_chunks(sf, soql, set(content_doc_ids), query_all=query_all):
+        for r in records:
             out[r["ContentDocumentId"]] = r
     return out
 
@@ -124,21 +128,21 @@ def fetch_link_meta_bulk(sf: Salesforce, pairs):
     pairs: set of (ContentDocumentId, Source_Parent_Id)
     Returns dict[(cdid, src_parent)] = {"ShareType": "...", "Visibility": "..."}
     """
-    out = {}
-    # chunk by content doc id set; we need both conditions in where
-    pairs = list(pairs)
-    for i in range(0, len(pairs), CHUNK_SIZE):
-        chunk = pairs[i:i+CHUNK_SIZE]
+    def soql_for(chunk):
         cdids = list({cd for cd, _ in chunk})
         parents = list({p for _, p in chunk if p})
         # Query by both lists then filter in Python
-        soql = f"""
+        return f"""
             SELECT ContentDocumentId, LinkedEntityId, ShareType, Visibility
             FROM ContentDocumentLink
             WHERE ContentDocumentId IN ({soql_list(cdids)})
             {"AND LinkedEntityId IN (" + soql_list(parents) + ")" if parents else ""}
         """
-        for r in query_all(sf, soql):
+
+    out = {}
+    # chunk by content doc id set; we need both conditions in where (two IN lists, so CHUNK_SIZE pairs per query)
+    for records in query_in_chunks(sf, soql_for, pairs, CHUNK_SIZE, query_all=query_all):
+        for r in records:
             key = (r["ContentDocumentId"], r["LinkedEntityId"])
             out[key] = {"ShareType": r.get("ShareType") or "V", "Visibility": r.get("Visibility") or "AllUsers"}
     return out
@@ -146,25 +150,95 @@ def fetch_link_meta_bulk(sf: Salesforce, pairs):
 # -----------------------------
 # Download & Upload helpers
 # -----------------------------
-def download_file_as_base64(sf: Salesforce, version_id: str) -> str:
+def download_version_body(sf: Salesforce, version_id: str, entity: dict, path_on_client: str):
+    """
+    Stream VersionData from the source org into a SpooledTemporaryFile laid out as
+    the multipart/form-data body for upload_content_version, so the file is never
+    held in memory whole (bodies over SPOOL_MAX_BYTES live on disk).
+    Returns (body rewound to the start, body length, boundary); the caller closes body.
+    """
     url = f"https://{sf.sf_instance}/services/data/{API_VERSION}/sobjects/ContentVersion/{version_id}/VersionData"
-    resp = requests.get(url, headers={'Authorization': 'Bearer ' + sf.session_id}, stream=True, timeout=300)
+    boundary = uuid.uuid4().hex
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        body.write((
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="entity_content"\r\n'
+            f"Content-Type: application/json\r\n\r\n"
+            f"{json.dumps(entity)}\r\n"
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="VersionData"; filename="{path_on_client}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8"))
+        with sf.session.get(url, headers={'Authorization': 'Bearer ' + sf.session_id}, stream=True, timeout=300) as resp:
+            resp.raise_for_status()
+            for block in resp.iter_content(STREAM_CHUNK_BYTES):
+                body.write(block)
+        body.write(f"\r\n--{boundary}--\r\n".encode("ascii"))
+        length = body.tell()
+        body.seek(0)
+    except BaseException:
+        body.close()
+        raise
+    return body, length, boundary
+
+def upload_content_version(sf_target: Salesforce, body, length: int, boundary: str) -> dict:
+    """
+    Create a ContentVersion from a body built by download_version_body. VersionData
+    goes over the wire as raw binary, streamed from the spooled file.
+    """
+    url = f"https://{sf_target.sf_instance}/services/data/{API_VERSION}/sobjects/ContentVersion/"
+    resp = sf_target.session.post(
+        url,
+        headers={
+            'Authorization': 'Bearer ' + sf_target.session_id,
+            'Content-Type': f"multipart/form-data; boundary={boundary}",
+            'Content-Length': str(length),
+        },
+        data=body,
+        timeout=300,
+    )
     resp.raise_for_status()
-    return base64.b64encode(resp.content).decode("utf-8")
+    return resp.json()
 
 def sanitize_path(title: str, path_on_client: str | None) -> str:
-    candidate = (path_on_client or f"{title}.bin").strip()
-    candidate = INVALID_FS_CHARS.sub("_", candidate) or "file.bin"
-    return candidate
+    return (path_on_client or f"{title}.bin").strip().translate(_FS_TRANS) or "file.bin"
 
-def create_cdl(sf_target: Salesforce, new_doc_id: str, parent_id: str, share_type: str, visibility: str):
-    payload = {
+def cdl_payload(new_doc_id: str, parent_id: str, share_type: str, visibility: str) -> dict:
+    return {
+        "attributes": {"type": "ContentDocumentLink"},
         "ContentDocumentId": new_doc_id,
         "LinkedEntityId": parent_id,
         "ShareType": share_type or "V",
         "Visibility": visibility or "AllUsers",
     }
-    sf_target.ContentDocumentLink.create(payload)
+
+def create_cdls(sf_target: Salesforce, payloads):
+    """
+    Insert ContentDocumentLinks through the sObject Collections endpoint,
+    up to COMPOSITE_BATCH_SIZE records per request.
+    Returns one {"id", "success", "errors"} dict per payload, in order.
+    """
+    out = []
+    for i in range(0, len(payloads), COMPOSITE_BATCH_SIZE):
+        batch = payloads[i:i+COMPOSITE_BATCH_SIZE]
+        try:
+            out.extend(sf_target.restful(
+                "composite/sobjects", method="POST",
+                json={"allOrNone": False, "records": batch}
+            ))
+        except Exception as e:
+            out.extend({"id": None, "success": False, "errors": [{"message": str(e)}]} for _ in batch)
+    return out
+
+def flush_links(sf_target: Salesforce, pending_links):
+    """Create all queued links and log the outcome of each."""
+    for p, res in zip(pending_links, create_cdls(sf_target, pending_links)):
+        if res.get("success"):
+            log_and_print(f"🔗 Linked {p['ContentDocumentId']} → {p['LinkedEntityId']} (ShareType={p['ShareType']}, Visibility={p['Visibility']})")
+        else:
+            errors = "; ".join(e.get("message", str(e)) if isinstance(e, dict) else str(e) for e in res.get("errors", []))
+            log_and_print(f"[ERROR] Failed linking {p['ContentDocumentId']} → {p['LinkedEntityId']}: {errors}", "error")
 
 # -----------------------------
 # Main migration
@@ -177,17 +251,20 @@ def migrate_versions(sf_source, sf_target, map_rows):
     for row in map_rows:
         by_doc[row["ContentDocumentId"]].append(row)
 
-    # Fetch latest versions for unique docs
-    latest_by_doc = fetch_latest_versions(sf_source, list(by_doc.keys()))
-    log_and_print(f"[INFO] Latest versions fetched for {len(latest_by_doc)}/{len(by_doc)} ContentDocuments")
-
-    # Prepare link meta if missing
+    # Pairs that need ShareType/Visibility looked up (depends only on the mapping rows)
     missing_meta_pairs = set()
     for cdid, rows in by_doc.items():
         for r in rows:
             if (not r.get("ShareType") or not r.get("Visibility")) and r.get("Source_Parent_Id"):
                 missing_meta_pairs.add((cdid, r["Source_Parent_Id"]))
-    link_meta = fetch_link_meta_bulk(sf_source, missing_meta_pairs) if missing_meta_pairs else {}
+
+    # Fetch latest versions and missing link meta from the source org side by side
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_latest = ex.submit(fetch_latest_versions, sf_source, list(by_doc.keys()))
+        f_meta = ex.submit(fetch_link_meta_bulk, sf_source, missing_meta_pairs) if missing_meta_pairs else None
+        latest_by_doc = f_latest.result()
+        link_meta = f_meta.result() if f_meta else {}
+    log_and_print(f"[INFO] Latest versions fetched for {len(latest_by_doc)}/{len(by_doc)} ContentDocuments")
 
     new_doc_by_old_doc = {}  # old ContentDocumentId -> new ContentDocumentId
     new_ver_by_old_ver = {}  # old ContentVersionId  -> new ContentVersionId
@@ -197,6 +274,8 @@ def migrate_versions(sf_source, sf_target, map_rows):
     for c in range(0, len(doc_ids), CHUNK_SIZE):
         doc_chunk = doc_ids[c:c+CHUNK_SIZE]
         log_and_print(f"[INFO] Processing doc chunk {c//CHUNK_SIZE + 1}/{math.ceil(len(doc_ids)/CHUNK_SIZE)} ({len(doc_chunk)} docs)")
+        pending_links = []  # ContentDocumentLink payloads created in one pass per chunk
+        uploaded = {}  # old ContentDocumentId -> new ContentVersionId, resolved after the chunk
 
         for cdid in doc_chunk:
             version = latest_by_doc.get(cdid)
@@ -211,42 +290,66 @@ def migrate_versions(sf_source, sf_target, map_rows):
             size_bytes = int(version.get("ContentSize") or 0)
 
             # Upload once per document
-            if old_doc_id not in new_doc_by_old_doc:
-                if size_bytes > REST_MAX_SIZE_BYTES:
-                    log_and_print(
-                        f"[ERROR] {old_doc_id} latest version {old_ver_id} is {size_bytes} bytes (>50MB). "
-                        f"Skipping REST upload. Implement multipart/resumable for large files.", "error"
-                    )
-                    continue
-
-                try:
-                    file_b64 = download_file_as_base64(sf_source, old_ver_id)
-                except Exception as e:
-                    log_and_print(f"[ERROR] Failed to download VersionData {old_ver_id}: {e}", "error")
-                    continue
+            if old_doc_id in new_doc_by_old_doc or old_doc_id in uploaded:
+                continue
+            if size_bytes > MULTIPART_MAX_SIZE_BYTES:
+                log_and_print(
+                    f"[ERROR] {old_doc_id} latest version {old_ver_id} is {size_bytes} bytes (>2GB). "
+                    f"Skipping upload: above the multipart ContentVersion limit.", "error"
+                )
+                continue
 
-                try:
-                    create_resp = sf_target.ContentVersion.create({
-                        "Title": title,
-                        "PathOnClient": path_on_client,
-                        "VersionData": file_b64,
-                        "Card_Legacy_Id__c": old_ver_id  # optional traceability
-                    })
-                    new_ver_id = create_resp["id"]
-                    # Fetch ContentDocumentId of the new version
-                    new_ver = sf_target.ContentVersion.get(new_ver_id)
-                    new_doc_id = new_ver["ContentDocumentId"]
+            try:
+                body, length, boundary = download_version_body(sf_source, old_ver_id, {
+                    "Title": title,
+                    "PathOnClient": path_on_client,
+                    "Card_Legacy_Id__c": old_ver_id  # optional traceability
+                }, path_on_client)
+            except Exception as e:
+                log_and_print(f"[ERROR] Failed to download VersionData {old_ver_id}: {e}", "error")
+                continue
 
-                    new_ver_by_old_ver[old_ver_id] = new_ver_id
-                    new_doc_by_old_doc[old_doc_id] = new_doc_id
+            try:
+                with body:
+                    create_resp = upload_content_version(sf_target, body, length, boundary)
+                new_ver_id = create_resp["id"]
+                new_ver_by_old_ver[old_ver_id] = new_ver_id
+                uploaded[old_doc_id] = new_ver_id
+            except Exception as e:
+                log_and_print(f"[ERROR] Failed to create ContentVersion for {old_ver_id}: {e}", "error")
+                continue
 
-                    log_and_print(f"✅ Uploaded {old_ver_id} → {new_ver_id} (doc {old_doc_id} → {new_doc_id})")
-                except Exception as e:
-                    log_and_print(f"[ERROR] Failed to create ContentVersion for {old_ver_id}: {e}", "error")
+        # Resolve ContentDocumentId of every version uploaded in this chunk with one query
+        if uploaded:
+            try:
+                new_docs = {
+                    r["Id"]: r["ContentDocumentId"]
+                    for r in query_all(sf_target, f"""
+                        SELECT Id, ContentDocumentId
+                        FROM ContentVersion
+                        WHERE Id IN ({soql_list(uploaded.values())})
+                    """)
+                }
+            except Exception as e:
+                log_and_print(f"[ERROR] Failed to resolve ContentDocumentIds for {len(uploaded)} new versions: {e}", "error")
+                new_docs = {}
+            for old_doc_id, new_ver_id in uploaded.items():
+                new_doc_id = new_docs.get(new_ver_id)
+                if not new_doc_id:
+                    log_and_print(f"[ERROR] No ContentDocumentId returned for new version {new_ver_id} (doc {old_doc_id})", "error")
                     continue
-            else:
-                new_doc_id = new_doc_by_old_doc[old_doc_id]
-                new_ver_id = new_ver_by_old_ver.get(old_ver_id)  # may be None if created in a different chunk, but not critical
+                new_doc_by_old_doc[old_doc_id] = new_doc_id
+                log_and_print(f"✅ Uploaded {latest_by_doc[old_doc_id]['Id']} → {new_ver_id} (doc {old_doc_id} → {new_doc_id})")
+
+        for cdid in doc_chunk:
+            version = latest_by_doc.get(cdid)
+            if not version or version["ContentDocumentId"] not in new_doc_by_old_doc:
+                continue
+
+            old_ver_id = version["Id"]
+            old_doc_id = version["ContentDocumentId"]
+            new_doc_id = new_doc_by_old_doc[old_doc_id]
+            new_ver_id = new_ver_by_old_ver.get(old_ver_id)
 
             # Create ALL requested links to target parents for this document
             for m in by_doc[cdid]:
@@ -272,11 +375,7 @@ def migrate_versions(sf_source, sf_target, map_rows):
                     share_type = share_type or meta.get("ShareType") or "V"
                     visibility = visibility or meta.get("Visibility") or "AllUsers"
 
-                try:
-                    create_cdl(sf_target, new_doc_id, target_parent_id, share_type, visibility)
-                    log_and_print(f"🔗 Linked {new_doc_id} → {target_parent_id} (ShareType={share_type}, Visibility={visibility})")
-                except Exception as e:
-                    log_and_print(f"[ERROR] Failed linking {new_doc_id} → {target_parent_id}: {e}", "error")
+                pending_links.append(cdl_payload(new_doc_id, target_parent_id, share_type, visibility))
 
                 results.append({
                     "Old_ContentVersionId": old_ver_id,
@@ -286,10 +385,13 @@ def migrate_versions(sf_source, sf_target, map_rows):
                     "Target_Parent_Id": target_parent_id
                 })
 
+        if pending_links:
+            flush_links(sf_target, pending_links)
+
     return results
 
 def write_mapping(results):
-    with open(OUTPUT_VERSION_MAPPING_FILE, "w", newline="", encoding="utf-8") as f:
+    with open(OUTPUT_VERSION_MAPPING_FILE, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
         writer = csv.DictWriter(
             f,
             fieldnames=[
@@ -317,5 +419,4 @@ def main():
     log_and_print(f"[INFO] Output mapping file: {OUTPUT_VERSION_MAPPING_FILE}")
 
 if __name__ == "__main__":
-    import time
     main()
@@ -8,15 +8,47 @@ Export EmailMessage from Salesforce source arg and insert in Taregt org.
 import csv
 import os
 import logging
+import queue
+import threading
 import pandas as pd
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from mappings import fetch_target_mappings,fetch_createdByIds,fetch_service_appointment_ids,FILES_DIR
+from mappings import fetch_target_mappings,fetch_createdByIds,fetch_service_appointment_ids,query_in_chunks,FILES_DIR
 
 EM_export = os.path.join(FILES_DIR, "eventMessage_export.csv")     
 EM_import = os.path.join(FILES_DIR, "eventMessage_import.csv")     
 emailtemplate_mapping = os.path.join(FILES_DIR, "emailtemplate_mapping.csv")
 log_file = os.path.join(FILES_DIR, "emailmessage_migration.log")
+QUEUE_MAX_BATCHES = 4  # prepared batches buffered ahead of the inserter
+INSERT_WORKERS = 8  # bulk insert batches in flight at once
+INSERT_WINDOW = INSERT_WORKERS * 2  # submitted batches whose results are not yet written
+
+EM_FIELDS = (
+    "Id,ParentId,TextBody, HtmlBody,ActivityId,Headers,Subject,FromName,FromAddress,ValidatedFromAddress,"
+    "ToAddress,CcAddress,BccAddress,Incoming,Status,MessageDate,ReplyToEmailMessageId,MessageIdentifier,"
+    "ThreadIdentifier,ClientThreadIdentifier,FromId,IsClientManaged,AttachmentIds,RelatedToId, RelatedTo.Type,"
+    "IsTracked,FirstOpenedDate,LastOpenedDate,IsBounced,EmailTemplateId,EmailRoutingAddressId,AutomationType"
+)
+# Queried fields copied as-is into the insert payload
+# (Id, ActivityId, RelatedTo, ValidatedFromAddress are not insertable;
+# FromId, RelatedToId, EmailTemplateId are remapped to target Ids)
+INSERTABLE_FIELDS = (
+    "ParentId", "TextBody", "HtmlBody", "Headers", "Subject", "FromName", "FromAddress",
+    "ToAddress", "CcAddress", "BccAddress", "Incoming", "Status", "MessageDate",
+    "ReplyToEmailMessageId", "MessageIdentifier", "ThreadIdentifier", "ClientThreadIdentifier",
+    "IsClientManaged", "AttachmentIds", "IsTracked", "FirstOpenedDate", "LastOpenedDate",
+    "IsBounced", "EmailRoutingAddressId", "AutomationType",
+)
+
+# Source field -> column in the EM_export audit file
+AUDIT_COLUMNS = {
+    "Id": "Source_EM_Id", "RelatedToId": "Source_RelatedId", "FromId": "Source_FromId",
+    "Target_FromId": "Target_FromId", "Target_RelatedToId": "Target_RelatedToId",
+    "Target_EmailTemplateId": "Target_EmailTemplateId",
+}
 
 # === Logging setup ===
 logging.basicConfig(
@@ -36,9 +68,9 @@ OBJECT_CONDITIONS = {
 def fetch_em_records(sf):
     """Fetch EmailMessage records first, then filter based on parent object conditions."""
 
-    # 1. Fetch EmailMessages with parent type
+    # 1. Narrow scan of EmailMessages with parent type; bodies are fetched only for kept emails
     query = """
-        SELECT Id,ParentId,TextBody, HtmlBody,ActivityId,Headers,Subject,FromName,FromAddress,ValidatedFromAddress,ToAddress,CcAddress,BccAddress,Incoming,Status,MessageDate,ReplyToEmailMessageId,MessageIdentifier,ThreadIdentifier,ClientThreadIdentifier,FromId,IsClientManaged,AttachmentIds,RelatedToId, RelatedTo.Type,IsTracked,FirstOpenedDate,LastOpenedDate,IsBounced,EmailTemplateId,EmailRoutingAddressId,AutomationType
+        SELECT Id, RelatedToId, RelatedTo.Type
         FROM EmailMessage
         WHERE RelatedToId != NULL
         AND RelatedTo.Type IN ('Impact_Tracker__c','ServiceAppointment')
@@ -52,17 +84,25 @@ def fetch_em_records(sf):
         logging.warning("No EmailMessages found in last 24 months.")
         return []
 
-    # 2. Group parent IDs by object type (RelatedTo.Type)
-    parent_map = {}
+    # 2. Group parent IDs by object type (RelatedTo.Type), remembering each email's parent
+    parent_map = defaultdict(set)
+    by_parent = []
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     for e in emails:
-        obj_type = e.get("RelatedTo", {}).get("Type")
-        #obj_type = e.get("RelatedTo", {}).get("attributes", {}).get("type")
-        print(f"[DEBUG] EmailMessage RelatedTo Type: {obj_type}")
+        rel = e.get("RelatedTo") or {}
+        obj_type = rel.get("Type")
+        #obj_type = rel.get("attributes", {}).get("type")
+        if debug:
+            logging.debug(f"[DEBUG] EmailMessage RelatedTo Type: {obj_type}")
         parent_id = e.get("RelatedToId")
         if obj_type and parent_id:
-            parent_map.setdefault(obj_type, set()).add(parent_id)
+            parent_map[obj_type].add(parent_id)
+            by_parent.append((parent_id, e))
 
     logging.info(f"[DEBUG] Parent object groups from EmailMessages: {list(parent_map.keys())}")
+    if not parent_map:
+        logging.warning("No EmailMessages with a RelatedTo parent.")
+        return []
 
     # 3. Validate parents based on OBJECT_CONDITIONS
     valid_parent_ids = set()
@@ -70,15 +110,12 @@ def fetch_em_records(sf):
     for obj_name, ids in parent_map.items():
         if obj_name in OBJECT_CONDITIONS and obj_name != "ServiceAppointment":
             cond = OBJECT_CONDITIONS[obj_name]
-            id_chunks = [list(ids)[i:i+2000] for i in range(0, len(ids), 2000)]
+            logging.info(f"[DEBUG] Fetching {obj_name} with condition: {cond} ({len(ids)} ids)")
 
-            for chunk in id_chunks:
-                ids_str = ",".join([f"'{i}'" for i in chunk])
-                query = f"SELECT Id FROM {obj_name} WHERE Id IN ({ids_str}) AND {cond}"
-                logging.info(f"[DEBUG] Fetching {obj_name} with condition: {cond} (batch {len(chunk)})")
-                res = sf.query_all(query)
-                valid_parent_ids.update([r["Id"] for r in res["records"]])
-                print(f"[DEBUG] Found {len(res['records'])} valid {obj_name} records")
+            soql = f"SELECT Id FROM {obj_name} WHERE Id IN ({{ids}}) AND {cond}"
+            for records in query_in_chunks(sf, soql, ids):
+                valid_parent_ids.update([r["Id"] for r in records])
+                print(f"[DEBUG] Found {len(records)} valid {obj_name} records")
 
         elif obj_name == "ServiceAppointment":
             sa_ids = fetch_service_appointment_ids(sf, sa_ids=ids)
@@ -89,12 +126,24 @@ def fetch_em_records(sf):
         logging.warning("No parent records matched given conditions.")
         return []
 
-    # 4. Filter emails to keep only those with valid parents
-    filtered_emails = [e for e in emails if e.get("RelatedToId") in valid_parent_ids]
+    # 4. Keep only emails with valid parents, then fetch their full records
+    valid = frozenset(valid_parent_ids)
+    kept_ids = [e["Id"] for p, e in by_parent if p in valid]
+
+    full_by_id = {}
+    for records in query_in_chunks(sf, f"SELECT {EM_FIELDS} FROM EmailMessage WHERE Id IN ({{ids}})", kept_ids):
+        full_by_id.update((r["Id"], r) for r in records)
+    filtered_emails = [full_by_id[i] for i in kept_ids if i in full_by_id]
 
     logging.info(f"[INFO] Total EmailMessages fetched after filtering: {len(filtered_emails)}")
     return filtered_emails
 
+@lru_cache(maxsize=4)
+def _load_template_map(path, mtime):
+    """Source -> target EmailTemplate Id map; mtime is part of the key so an edited file is re-read."""
+    df = pd.read_csv(path, usecols=["SourceTemplateId", "TargetTemplateId"], dtype=str)
+    return dict(zip(df["SourceTemplateId"], df["TargetTemplateId"]))
+
 def fetch_target_ids(sf_target, records):
     from_ids = set()
     sa_related_ids = set()
@@ -105,24 +154,27 @@ def fetch_target_ids(sf_target, records):
     relatedTo_mappings = {}    
     for rec in records:
 
-        if rec.get("FromId") and rec["FromId"] not in from_ids and rec["FromId"] != "":
-            from_ids.add(rec["FromId"])
+        fid = rec.get("FromId")
+        if fid:
+            from_ids.add(fid)
 
-        if rec.get("RelatedToId") and rec["RelatedToId"] != "":
-            if rec["RelatedTo"]["Type"] == "Impact_Tracker__c":
-                it_related_ids.add(rec["RelatedToId"])
-            elif rec["RelatedTo"]["Type"] == "ServiceAppointment":
-                sa_related_ids.add(rec["RelatedToId"])
+        rid = rec.get("RelatedToId")
+        if rid:
+            rel_type = (rec.get("RelatedTo") or {}).get("Type")
+            if rel_type == "Impact_Tracker__c":
+                it_related_ids.add(rid)
+            elif rel_type == "ServiceAppointment":
+                sa_related_ids.add(rid)
 
-        if rec.get("EmailTemplateId") and rec["EmailTemplateId"] not in emailTemplate_ids and rec["EmailTemplateId"] != "":
-            emailTemplate_ids.add(rec["EmailTemplateId"])
+        tid = rec.get("EmailTemplateId")
+        if tid:
+            emailTemplate_ids.add(tid)
 
     from_mappings = fetch_target_mappings(sf_target, "User", from_ids, 200)
     relatedTo_mappings.update(fetch_target_mappings(sf_target, "Impact_Tracker__c", it_related_ids, 200))
     relatedTo_mappings.update(fetch_target_mappings(sf_target, "ServiceAppointment", sa_related_ids, 200))
     
-    df = pd.read_csv(emailtemplate_mapping)
-    emailtemplate_mappings = dict(zip(df['SourceTemplateId'], df['TargetTemplateId']))
+    emailtemplate_mappings = _load_template_map(emailtemplate_mapping, os.path.getmtime(emailtemplate_mapping))
     
     for rec in records:
         rec["Target_FromId"] = from_mappings.get(rec.get("FromId"), None)
@@ -131,86 +183,129 @@ def fetch_target_ids(sf_target, records):
     
     return records
 
-def export_activity(sf_source, sf_target, object_name, batch_size=200):
-    """Main export function for EM."""
-
-    prepared_records = []
-    skipped_records = []
-    em_records = fetch_em_records(sf_source)
-    em_records = fetch_target_ids(sf_target, em_records)
-
+def prepare_batches(em_records, batch_size, q, audit_writer, errors):
+    """
+    Producer: write each record's audit row, build insert payloads and put
+    (batch, skipped) pairs on q, one per batch_size prepared records.
+    None always marks the end of the stream; an exception raised while
+    preparing is appended to errors for the consumer to re-raise.
+    """
+    try:
+        _prepare_batches(em_records, batch_size, q, audit_writer)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        q.put(None)
+
+def _prepare_batches(em_records, batch_size, q, audit_writer):
+    batch = []
+    skipped = []
     for rec in em_records:
+        audit_writer.writerow({col: rec.get(src) for src, col in AUDIT_COLUMNS.items()})
+
         # Skip if parent or email template mapping is missing
         if not rec.get("Target_RelatedToId"):
-            skipped_records.append((rec["Id"], "No mapped parent"))
+            skipped.append((rec["Id"], "No mapped parent"))
             continue
         if rec.get("EmailTemplateId") and not rec.get("Target_EmailTemplateId"):
-            skipped_records.append((rec["Id"], "Unmapped EmailTemplate"))
+            skipped.append((rec["Id"], "Unmapped EmailTemplate"))
             continue
 
-        insert_data = rec.copy()
+        insert_data = {k: rec.get(k) for k in INSERTABLE_FIELDS}
         insert_data["FromId"] = rec["Target_FromId"]
         insert_data["RelatedToId"] = rec["Target_RelatedToId"]
         insert_data["EmailTemplateId"] = rec["Target_EmailTemplateId"]
         insert_data["status"] = "5"  # Sent
         insert_data["Card_Legacy_Id__c"] = rec["Id"]  # Custom field to track legacy ID
 
-        # Remove non-insertable fields
-        # Headers, AttachmentIds, FirstOpenedDate, LastOpenedDate
-        for f in ["Id", "ActivityId", "RelatedTo", "Target_FromId", "Target_RelatedToId",
-                  "Target_EmailTemplateId", "ValidatedFromAddress"]:
-            insert_data.pop(f, None)
-
-        prepared_records.append((rec["Id"], insert_data))
-
-    # --- Export mapping for audit ---
-    with open(EM_export, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        header = ["Source_EM_Id", "Source_RelatedId", "Source_FromId",
-                  "Target_FromId", "Target_RelatedToId", "Target_EmailTemplateId"]
-        writer.writerow(header)
-        for rec in em_records:
-            writer.writerow([
-                rec["Id"], rec.get("RelatedToId", ""), rec.get("FromId", ""),
-                rec.get("Target_FromId", ""), rec.get("Target_RelatedToId", ""),
-                rec.get("Target_EmailTemplateId", "")
-            ])
-
-    print(f"[SUCCESS] Prepared {len(prepared_records)} records, skipped {len(skipped_records)} → {EM_export}")
-
-    # --- Insert in chunks ---
-    with open(EM_import, "w", newline="", encoding="utf-8") as f:
+        batch.append((rec["Id"], insert_data))
+        if len(batch) == batch_size:
+            q.put((batch, skipped))
+            batch, skipped = [], []
+
+    if batch or skipped:
+        q.put((batch, skipped))
+
+def insert_one_batch(sf_target, object_name, batch, batch_size, batch_no):
+    """
+    Bulk insert one prepared batch; returns (source_ids, results).
+    Not retried: a bulk insert is not idempotent, so a failure after Salesforce
+    accepted the batch would duplicate EmailMessages. Failed batches are reported
+    row by row instead.
+    """
+    source_ids = [sid for sid, _ in batch]
+    objs = [obj for _, obj in batch]
+
+    print(f"[INFO] Inserting batch {batch_no} with {len(batch)} records...")
+    try:
+        return source_ids, sf_target.bulk.__getattr__(object_name).insert(objs, batch_size=batch_size)
+    except Exception as e:
+        logging.error(f"Batch {batch_no} failed: {e}")
+        return source_ids, [{"id": None, "errors": [str(e)]} for _ in source_ids]
+
+def export_activity(sf_source, sf_target, object_name, batch_size=200):
+    """Main export function for EM."""
+
+    em_records = fetch_em_records(sf_source)
+    em_records = fetch_target_ids(sf_target, em_records)
+
+    inserted_count = 0
+    skipped_count = 0
+    batch_no = 0
+    producer_errors = []
+    q = queue.Queue(maxsize=QUEUE_MAX_BATCHES)
+    with (
+        open(EM_export, "w", newline="", encoding="utf-8", buffering=1 << 20) as audit_f,
+        open(EM_import, "w", newline="", encoding="utf-8", buffering=1 << 20) as f,
+    ):
+        # --- Audit rows and insert payloads are produced in one pass on a producer thread ---
+        audit_writer = csv.DictWriter(audit_f, fieldnames=list(AUDIT_COLUMNS.values()))
+        audit_writer.writeheader()
+        producer = threading.Thread(target=prepare_batches, args=(em_records, batch_size, q, audit_writer, producer_errors), daemon=True)
+        producer.start()
+
+        # --- Insert batches concurrently as the producer hands them over ---
         writer = csv.writer(f)
         writer.writerow(["Source_Activity_Id", "Target_Activity_Id", "Success", "Errors"])
 
-        # Write skipped first
-        for sid, reason in skipped_records:
-            logging.warning(f"Skipped {sid}: {reason}")
-            writer.writerow([sid, "", "Skipped", reason])
-
-        # Insert in chunks of batch_size
-        for i in range(0, len(prepared_records), batch_size):
-            batch = prepared_records[i:i + batch_size]
-            source_ids = [sid for sid, _ in batch]
-            objs = [obj for _, obj in batch]
-
-            print(f"[INFO] Inserting batch {i//batch_size + 1} with {len(batch)} records...")
-            results = sf_target.bulk.__getattr__(object_name).insert(objs, batch_size=batch_size)
-
-            for sid, res in zip(source_ids, results):
-                errors = res.get("errors", [])
-                if not errors:
-                    writer.writerow([sid, res.get("id", ""), True, ""])
-                else:
-                    error_msgs = []
-                    for e in errors:
-                        if isinstance(e, dict):
-                            error_msgs.append(e.get("message", str(e)))
-                        else:
-                            error_msgs.append(str(e))
-                    writer.writerow([sid, "", False, ";".join(error_msgs)])
-
-    logging.info(f"[INFO] Migration complete. Inserted {len(prepared_records)} records, skipped {len(skipped_records)}.")
+        def result_row(sid, res):
+            errors = res.get("errors", [])
+            if not errors:
+                return (sid, res.get("id", ""), True, "")
+            error_msgs = [e.get("message", str(e)) if isinstance(e, dict) else str(e) for e in errors]
+            return (sid, "", False, ";".join(error_msgs))
+
+        def write_results(future):
+            source_ids, results = future.result()
+            writer.writerows(result_row(sid, res) for sid, res in zip(source_ids, results))
+
+        # Keep at most INSERT_WINDOW batches in flight; write results oldest first
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=INSERT_WORKERS) as ex:
+            while (item := q.get()) is not None:
+                batch, skipped = item
+
+                for sid, reason in skipped:
+                    logging.warning(f"Skipped {sid}: {reason}")
+                writer.writerows((sid, "", "Skipped", reason) for sid, reason in skipped)
+                skipped_count += len(skipped)
+
+                if not batch:
+                    continue
+                batch_no += 1
+                inserted_count += len(batch)
+                pending.append(ex.submit(insert_one_batch, sf_target, object_name, batch, batch_size, batch_no))
+                if len(pending) >= INSERT_WINDOW:
+                    write_results(pending.popleft())
+
+            while pending:
+                write_results(pending.popleft())
+
+        producer.join()
+        if producer_errors:
+            raise producer_errors[0]
+    print(f"[SUCCESS] Prepared {inserted_count} records, skipped {skipped_count} → {EM_export}")
+    logging.info(f"[INFO] Migration complete. Inserted {inserted_count} records, skipped {skipped_count}.")
     logging.info(f"[INFO] Results saved to {EM_import}")
 
 if __name__ == "__main__":
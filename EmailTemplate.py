@@ -9,9 +9,10 @@ import csv
 import os
 import logging
 import pandas as pd
+from collections import defaultdict
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from mappings import fetch_target_mappings,fetch_createdByIds,fetch_service_appointment_ids,FILES_DIR
+from mappings import fetch_target_mappings,fetch_createdByIds,fetch_service_appointment_ids,query_in_chunks,FILES_DIR
 
 template_mapping_file = os.path.join(FILES_DIR, "emailtemplate_mapping_file.csv")
 log_file = os.path.join(FILES_DIR, "emailtemplate_migration.log")
@@ -37,6 +38,7 @@ def fetch_em_records(sf):
     # 1. Fetch EmailMessages with parent type
     query = """
         SELECT Id,EmailTemplateId,RelatedToId, RelatedTo.Type
+        FROM EmailMessage
         WHERE CreatedDate = TODAY
         AND RelatedToId != NULL
         AND EmailTemplateId != null
@@ -51,17 +53,25 @@ def fetch_em_records(sf):
         logging.warning("No EmailMessages found in last 24 months.")
         return []
 
-    # 2. Group parent IDs by object type (RelatedTo.Type)
-    parent_map = {}
+    # 2. Group parent IDs by object type (RelatedTo.Type), remembering each email's parent
+    parent_map = defaultdict(set)
+    by_parent = []
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     for e in emails:
-        obj_type = e.get("RelatedTo", {}).get("Type")
-        #obj_type = e.get("RelatedTo", {}).get("attributes", {}).get("type")
-        print(f"[DEBUG] EmailMessage RelatedTo Type: {obj_type}")
+        rel = e.get("RelatedTo") or {}
+        obj_type = rel.get("Type")
+        #obj_type = rel.get("attributes", {}).get("type")
+        if debug:
+            logging.debug(f"[DEBUG] EmailMessage RelatedTo Type: {obj_type}")
         parent_id = e.get("RelatedToId")
         if obj_type and parent_id:
-            parent_map.setdefault(obj_type, set()).add(parent_id)
+            parent_map[obj_type].add(parent_id)
+            by_parent.append((parent_id, e))
 
     logging.info(f"[DEBUG] Parent object groups from EmailMessages: {list(parent_map.keys())}")
+    if not parent_map:
+        logging.warning("No EmailMessages with a RelatedTo parent.")
+        return []
 
     # 3. Validate parents based on OBJECT_CONDITIONS
     valid_parent_ids = set()
@@ -69,15 +79,12 @@ def fetch_em_records(sf):
     for obj_name, ids in parent_map.items():
         if obj_name in OBJECT_CONDITIONS and obj_name != "ServiceAppointment":
             cond = OBJECT_CONDITIONS[obj_name]
-            id_chunks = [list(ids)[i:i+2000] for i in range(0, len(ids), 2000)]
+            logging.info(f"[DEBUG] Fetching {obj_name} with condition: {cond} ({len(ids)} ids)")
 
-            for chunk in id_chunks:
-                ids_str = ",".join([f"'{i}'" for i in chunk])
-                query = f"SELECT Id FROM {obj_name} WHERE Id IN ({ids_str}) AND {cond}"
-                logging.info(f"[DEBUG] Fetching {obj_name} with condition: {cond} (batch {len(chunk)})")
-                res = sf.query_all(query)
-                valid_parent_ids.update([r["Id"] for r in res["records"]])
-                print(f"[DEBUG] Found {len(res['records'])} valid {obj_name} records")
+            soql = f"SELECT Id FROM {obj_name} WHERE Id IN ({{ids}}) AND {cond}"
+            for records in query_in_chunks(sf, soql, ids):
+                valid_parent_ids.update([r["Id"] for r in records])
+                print(f"[DEBUG] Found {len(records)} valid {obj_name} records")
 
         elif obj_name == "ServiceAppointment":
             sa_ids = fetch_service_appointment_ids(sf, sa_ids=ids)
@@ -89,7 +96,8 @@ def fetch_em_records(sf):
         return []
 
     # 4. Filter emails to keep only those with valid parents
-    filtered_emails = [e for e in emails if e.get("RelatedToId") in valid_parent_ids]
+    valid = frozenset(valid_parent_ids)
+    filtered_emails = [e for p, e in by_parent if p in valid]
 
     logging.info(f"[INFO] Total EmailMessages fetched after filtering: {len(filtered_emails)}")
     return filtered_emails
@@ -97,21 +105,15 @@ def fetch_em_records(sf):
 def fetch_templates(sf, template_ids):
     """Fetch EmailTemplate records for given IDs from source org."""
     all_templates = []
-    id_list = list(template_ids)
-
-    # Chunk into batches of 2000 (SOQL limit)
-    for i in range(0, len(id_list), 2000):
-        chunk = id_list[i:i+2000]
-        ids_str = ",".join([f"'{i}'" for i in chunk])
-        query = f"""
-            SELECT Id, Name, DeveloperName, ApiVersion, FolderId, 
-                   Subject, HtmlValue, Body, TemplateType
-            FROM EmailTemplate
-            WHERE Id IN ({ids_str})
-        """
-        res = sf.query_all(query)
-        all_templates.extend(res["records"])
-        logging.info(f"[DEBUG] Fetched {len(res['records'])} templates in batch")
+    soql = """
+        SELECT Id, Name, DeveloperName, ApiVersion, FolderId, 
+               Subject, HtmlValue, Body, TemplateType
+        FROM EmailTemplate
+        WHERE Id IN ({ids})
+    """
+    for records in query_in_chunks(sf, soql, template_ids):
+        all_templates.extend(records)
+        logging.info(f"[DEBUG] Fetched {len(records)} templates in batch")
 
     return all_templates
 
@@ -120,16 +122,22 @@ def insert_templates(sf_target, templates):
     """Insert templates into target org and return mapping dict."""
     mapping = {}
 
+    # Look up templates that already exist in target, 200 DeveloperNames per query
+    existing = {}
+    dev_names = {t["DeveloperName"] for t in templates if t.get("DeveloperName")}
+    for records in query_in_chunks(sf_target, "SELECT Id, DeveloperName FROM EmailTemplate WHERE DeveloperName IN ({ids})", dev_names, 200):
+        existing.update({r["DeveloperName"]: r["Id"] for r in records})
+
+    new_tpls = []
+    src_tpls = []
     for tpl in templates:
         src_id = tpl["Id"]
         name = tpl["Name"]
 
-        # Check if template with same name already exists in target
-        check = sf_target.query_all(f"SELECT Id FROM EmailTemplate WHERE Name = '{name}'")
-        if check["records"]:
-            tgt_id = check["records"][0]["Id"]
+        # Template with same DeveloperName already exists in target
+        if tpl.get("DeveloperName") in existing:
             logging.info(f"Template '{name}' already exists in target. Mapping only.")
-            mapping[src_id] = tgt_id
+            mapping[src_id] = existing[tpl["DeveloperName"]]
             continue
 
         # Prepare record
@@ -142,17 +150,28 @@ def insert_templates(sf_target, templates):
             "TemplateType": tpl.get("TemplateType"),
             "FolderId": tpl.get("FolderId")  # ⚠️ FolderId may differ across orgs
         }
+        new_tpls.append(new_tpl)
+        src_tpls.append(tpl)
 
-        try:
-            result = sf_target.EmailTemplate.create(new_tpl)
-            if result.get("success"):
-                tgt_id = result["id"]
-                mapping[src_id] = tgt_id
-                logging.info(f"Inserted template '{name}' → {tgt_id}")
-            else:
-                logging.error(f"Failed to insert template '{name}': {result}")
-        except Exception as e:
-            logging.error(f"Error inserting template '{name}': {str(e)}")
+    if not new_tpls:
+        return mapping
+
+    # Insert all new templates in one bulk job. Not retried or re-sent through REST: the job
+    # may already have been accepted when the call raises, so every template is reported failed
+    try:
+        results = sf_target.bulk.EmailTemplate.insert(new_tpls, batch_size=200)
+    except Exception as e:
+        logging.error(f"Bulk insert of {len(new_tpls)} templates failed: {e}")
+        results = [{"success": False, "errors": [str(e)]} for _ in new_tpls]
+
+    for tpl, result in zip(src_tpls, results):
+        name = tpl["Name"]
+        if result.get("success"):
+            tgt_id = result["id"]
+            mapping[tpl["Id"]] = tgt_id
+            logging.info(f"Inserted template '{name}' → {tgt_id}")
+        else:
+            logging.error(f"Failed to insert template '{name}': {result}")
 
     return mapping
 
@@ -162,15 +181,14 @@ def save_mapping(mapping):
     with open(template_mapping_file, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["SourceTemplateId", "TargetTemplateId"])
-        for k, v in mapping.items():
-            writer.writerow([k, v])
+        writer.writerows(mapping.items())
 
 def export_template(sf_source, sf_target, object_name, batch_size=200):
     """Main export function for EM."""
     template_ids = set()
     
     em_records = fetch_em_records(sf_source)
-    template_ids.add(r["EmailTemplateId"] for r in em_records if r.get("EmailTemplateId"))
+    template_ids.update(r["EmailTemplateId"] for r in em_records if r.get("EmailTemplateId"))
     print(f"[DEBUG] Unique EmailTemplateIds from EmailMessages: {len(template_ids)}")
     logging.info(f"[INFO] Found {len(template_ids)} unique EmailTemplateIds")
     if not template_ids:
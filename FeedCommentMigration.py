@@ -11,13 +11,13 @@ Purpose:
 
 import csv
 import os
-import re
+import logging
+import pandas as pd
 from simple_salesforce import Salesforce
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from mappings import fetch_target_mappings, fetch_createdByIds, FILES_DIR
+from mappings import fetch_target_mappings, fetch_createdByIds, fetch_latest_version_ids, strip_images, query_in_chunks, IN_CHUNK_SIZE, FILES_DIR
 
-BATCH_SIZE = 200
 
 INPUT_CSV = os.path.join(FILES_DIR, "feeditem_results.csv")
 OUTPUT_CSV = os.path.join(FILES_DIR, "feedcomment_migration_log.csv")
@@ -26,26 +26,27 @@ OUTPUT_CSV = os.path.join(FILES_DIR, "feedcomment_migration_log.csv")
 def fetch_feedcomments(sf_source: Salesforce, feeditem_ids: set[str]):
     if not feeditem_ids:
         return []
-    ids_str = ",".join([f"'{fid}'" for fid in feeditem_ids])
-    query = f"""
+    soql = """
         SELECT Id, CommentBody, CreatedById, CreatedDate, ParentId, FeedItemId, RelatedRecordId,IsRichText,CommentType
         FROM FeedComment
-        WHERE FeedItemId IN ({ids_str})
+        WHERE FeedItemId IN ({ids})
         ORDER BY CreatedDate ASC
     """
-    results = sf_source.query_all(query)["records"]
+
+    results = []
+    for records in query_in_chunks(sf_source, soql, feeditem_ids):
+        results.extend(records)
+    # Each chunk is ordered; restore the overall CreatedDate order across chunks
+    results.sort(key=lambda r: r["CreatedDate"])
     print(f"[INFO] Fetched {len(results)} FeedComments from source org")
     results = related_recordid_mapping(sf_source, results)  # pass only sf + records
     return results
 
 def related_recordid_mapping(sf_source,records):
-    doc_ids = set()
-
-    for rec in records:
-        body = rec.get("CommentBody") or ""
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
-        for doc_id in matches:
-            doc_ids.add(doc_id)
+    # (ids, image-free body) per comment; bodies without "<img" are not scanned
+    bodies = (rec.get("CommentBody") or "" for rec in records)
+    per_rec_scan = [strip_images(body) if "<img" in body else ((), body) for body in bodies]
+    doc_ids = {doc_id for matches, _ in per_rec_scan for doc_id in matches}
 
     if not doc_ids:
         print("⚠️ No <img> tags found in FeedComment bodies, skipping RelatedRecordId mapping")
@@ -55,39 +56,34 @@ def related_recordid_mapping(sf_source,records):
     
     
     # Step 2: Fetch latest ContentVersion for all unique ContentDocumentIds
-    content_map = {}  # {ContentDocumentId: ContentVersionId}
-
-    if doc_ids:
-        ids_str = ",".join([f"'{d}'" for d in doc_ids])
-        ver_soql = f"""
-            SELECT ContentDocumentId, Id
-            FROM ContentVersion
-            WHERE ContentDocumentId IN ({ids_str}) AND IsLatest = true
-        """
-        ver_q = sf_source.query_all(ver_soql)["records"]
-        
-        for v in ver_q:
-            content_map[v["ContentDocumentId"]] = v["Id"]
+    content_map = fetch_latest_version_ids(sf_source, doc_ids)  # {ContentDocumentId: ContentVersionId}
 
     # Step 3: Update each record with RelatedRecordId if image found
-    for rec in records:
-        body = rec.get("CommentBody") or ""
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
+    for rec, (matches, new_body) in zip(records, per_rec_scan):
         if matches:
             doc_id = matches[0]  # pick first if multiple
             if doc_id in content_map:
                 rec["RelatedRecordId"] = content_map[doc_id]
-                body = re.sub(r'<img[^>]*>(?:</img>)?', '', body, flags=re.IGNORECASE)
-                rec["CommentBody"] = body.strip()
+                rec["CommentBody"] = new_body.strip()
     return records
 
-def insert_feedcomments(sf: Salesforce, comments, feeditem_mapping):
-    inserted_ids = []
+def insert_feedcomments(sf: Salesforce, comments, feeditem_mapping, writer):
+    """Insert comments in Bulk batches, writing one result row per source comment to writer."""
+    def write_row(src_id, tgt_id, src_feeditem, tgt_feeditem, status):
+        writer.writerow({
+            "Source_FeedComment_Id": src_id,
+            "Target_FeedComment_Id": tgt_id,
+            "Source_FeedItem_Id": src_feeditem,
+            "Target_FeedItem_Id": tgt_feeditem,
+            "Status": status
+        })
+
+    row_count = 0
     records_to_insert = []
-    record_pairs = []  # [(source_comment, new_comment)]
+    src_refs = []  # src_refs[k] is the source comment of records_to_insert[k]
 
     related_ids = {c["RelatedRecordId"] for c in comments if c.get("RelatedRecordId")}
-    relatedId_mappings = fetch_target_mappings(sf, "ContentVersion", related_ids, BATCH_SIZE)
+    relatedId_mappings = fetch_target_mappings(sf, "ContentVersion", related_ids, IN_CHUNK_SIZE)
 
     createdBy_Ids = {c["CreatedById"] for c in comments}
     createdBy_mappings = fetch_createdByIds(sf, createdBy_Ids)
@@ -99,7 +95,8 @@ def insert_feedcomments(sf: Salesforce, comments, feeditem_mapping):
 
             if not tgt_feeditem or not tgt_createdBy:
                 print(f"[WARN] Skipping FeedComment {c['Id']} - Missing FeedItem or CreatedBy mapping")
-                inserted_ids.append((c["Id"], None, c["FeedItemId"], tgt_feeditem, "Skipped - Missing mapping"))
+                write_row(c["Id"], None, c["FeedItemId"], tgt_feeditem, "Skipped - Missing mapping")
+                row_count += 1
                 continue
 
             new_comment = {
@@ -112,43 +109,46 @@ def insert_feedcomments(sf: Salesforce, comments, feeditem_mapping):
             if c.get("RelatedRecordId") in relatedId_mappings:
                 new_comment["RelatedRecordId"] = relatedId_mappings[c["RelatedRecordId"]]
 
-            record_pairs.append((c, new_comment))
+            src_refs.append(c)
             records_to_insert.append(new_comment)
-            
+
         except Exception as e:
-            inserted_ids.append((c["Id"], None, c["FeedItemId"], None, f"Prep Error: {str(e)}"))
+            write_row(c["Id"], None, c["FeedItemId"], None, f"Prep Error: {str(e)}")
+            row_count += 1
 
-    # Insert in chunks
+    # One bulk job: batch_size="auto" splits it within the per-batch record and 10 MB limits,
+    # the batches run in parallel, and results come back in input order
     print(f"[INFO] Prepared FeedComment {len(records_to_insert)} for insertion")
-    for i in range(0, len(records_to_insert), BATCH_SIZE):
-        batch = records_to_insert[i:i+BATCH_SIZE]
-        src_batch = [p[0] for p in record_pairs[i:i+BATCH_SIZE]]
-        results = sf.bulk.FeedComment.insert(batch)
-        
+    if records_to_insert:
+        try:
+            results = sf.bulk.FeedComment.insert(records_to_insert, batch_size="auto", use_serial=False)
+        except Exception as e:
+            logging.error(f"FeedComment bulk insert failed: {e}")
+            results = [{"success": False, "errors": [str(e)]} for _ in records_to_insert]
 
-        for c, res in zip(src_batch, results):
+        ok = 0
+        for c, res in zip(src_refs, results):
             if res.get("success"):
-                print(f"[INFO] Inserted FeedComment {c['Id']} as {res.get('id')}")
-                inserted_ids.append((c["Id"], res.get("id"), c["FeedItemId"], feeditem_mapping.get(c["FeedItemId"]), "Success"))
+                ok += 1
+                logging.debug("Inserted FeedComment %s as %s", c["Id"], res.get("id"))
+                write_row(c["Id"], res.get("id"), c["FeedItemId"], feeditem_mapping.get(c["FeedItemId"]), "Success")
             else:
                 msg = f"Failed: {res.get('errors')}"
-                print(f"[ERROR] FeedComment {c['Id']} failed → {msg}")
-                inserted_ids.append((c["Id"], None, c["FeedItemId"], feeditem_mapping.get(c["FeedItemId"]), msg))
+                logging.error(f"FeedComment {c['Id']} failed → {msg}")
+                write_row(c["Id"], None, c["FeedItemId"], feeditem_mapping.get(c["FeedItemId"]), msg)
+        row_count += len(src_refs)
+        print(f"[INFO] Bulk insert: {ok} inserted / {len(src_refs) - ok} failed")
 
-    print(f"[INFO] Inserted {len(inserted_ids)} FeedComments into target org")
-    return inserted_ids
+    print(f"[INFO] Inserted {row_count} FeedComments into target org")
+    return row_count
 
 # === Main Migration Process ===
 def migrate_feedcomments(sf_source, sf_target):
-    results = []
-    feeditem_mapping = {}
     src_ids = set()
     tgt_ids = set()
 
-    with open(INPUT_CSV, "r", newline="", encoding="utf-8") as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            feeditem_mapping[row["Source_FeedItem_Id"]] = row["Target_FeedItem_Id"]
+    df = pd.read_csv(INPUT_CSV, usecols=["Source_FeedItem_Id", "Target_FeedItem_Id"], dtype=str, keep_default_na=False)
+    feeditem_mapping = dict(zip(df["Source_FeedItem_Id"], df["Target_FeedItem_Id"]))
 
     print(f"[INFO] Found {len(feeditem_mapping)} FeedItems in mapping CSV")
 
@@ -157,19 +157,8 @@ def migrate_feedcomments(sf_source, sf_target):
         print(f"[INFO] No comments found")
         return
 
-    inserted = insert_feedcomments(sf_target, comments, feeditem_mapping)
-
-    for src_id, tgt_id, src_feeditem, tgt_feeditem, status in inserted:
-        results.append({
-            "Source_FeedComment_Id": src_id,
-            "Target_FeedComment_Id": tgt_id,
-            "Source_FeedItem_Id": src_feeditem,
-            "Target_FeedItem_Id": tgt_feeditem,
-            "Status": status
-        })
-
-    # === Write results to CSV ===
-    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as outfile:
+    # === Write results to CSV as each batch completes ===
+    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8", buffering=1 << 20) as outfile:
         writer = csv.DictWriter(outfile, fieldnames=[
             "Source_FeedComment_Id",
             "Target_FeedComment_Id",
@@ -178,7 +167,7 @@ def migrate_feedcomments(sf_source, sf_target):
             "Status"
         ])
         writer.writeheader()
-        writer.writerows(results)
+        insert_feedcomments(sf_target, comments, feeditem_mapping, writer)
 
     print(f"[INFO] Migration completed. Log saved in {OUTPUT_CSV}")
 
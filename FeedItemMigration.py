@@ -14,13 +14,19 @@ import os
 import csv
 import re
 import logging
-import html
-from simple_salesforce import Salesforce
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from mappings import fetch_target_mappings, fetch_createdByIds,fetch_service_appointment_ids,FILES_DIR
+from mappings import fetch_target_mappings, fetch_createdByIds,fetch_latest_version_ids,strip_images,query_in_chunks,IN_CHUNK_SIZE,FILES_DIR
 
-BATCH_SIZE = 200
+BATCH_SIZE = 200  # sObject Collections hard limit per insert request
+OBJECT_WORKERS = 4  # objects fetched side by side (each runs its own mappings.query_in_chunks lookups)
+INSERT_WORKERS = 8  # concurrent sObject Collections inserts (BATCH_SIZE records each)
+INSERT_WINDOW = INSERT_WORKERS * 2  # insert batches allowed in flight before results are written
+
+# System-generated status posts are not migrated; matched without lowercasing a copy of the body
+_SKIP_BODY_RE = re.compile(r'status changed to', re.IGNORECASE)
 
 RESULT_FILE = os.path.join(FILES_DIR, "feeditem_results.csv")
 LOG_FILE = os.path.join(FILES_DIR, "feeditem_migration.log")
@@ -57,13 +63,11 @@ OBJECT_CONDITIONS = {
 }
 
 def related_recordid_mapping(sf_source,sf_target,records):
-    doc_ids = set()
-
-    for rec in records:
-        body = rec.get("Body") or ""
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
-        for doc_id in matches:
-            doc_ids.add(doc_id)
+    # Scan each body once; ids and the image-free body are both reused below.
+    # The substring check skips the regex for the (common) bodies with no image.
+    bodies = (rec.get("Body") or "" for rec in records)
+    per_rec_scan = [strip_images(body) if "<img" in body else ((), body) for body in bodies]
+    doc_ids = {doc_id for matches, _ in per_rec_scan for doc_id in matches}
 
     if not doc_ids:
         print("⚠️ No <img> tags found in FeedItem bodies, skipping RelatedRecordId mapping")
@@ -71,71 +75,56 @@ def related_recordid_mapping(sf_source,sf_target,records):
     
     
     # Step 2: Fetch latest ContentVersion for all unique ContentDocumentIds
-    content_map = {}  # {ContentDocumentId: ContentVersionId}
-
-    if doc_ids:
-        ids_str = ",".join([f"'{d}'" for d in doc_ids])
-        ver_soql = f"""
-            SELECT ContentDocumentId, Id
-            FROM ContentVersion
-            WHERE ContentDocumentId IN ({ids_str}) AND IsLatest = true
-        """
-        ver_q = sf_source.query_all(ver_soql)["records"]
-        
-        for v in ver_q:
-            content_map[v["ContentDocumentId"]] = v["Id"]
+    content_map = fetch_latest_version_ids(sf_source, doc_ids)  # {ContentDocumentId: ContentVersionId}
 
     # Step 3: Update each record with RelatedRecordId if image found
-    for rec in records:
-        body = rec.get("Body") or ""
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
+    for rec, (matches, new_body) in zip(records, per_rec_scan):
         if matches:
             doc_id = matches[0]  # pick first if multiple
             if doc_id in content_map:
                 rec["RelatedRecordId"] = content_map[doc_id]
-                body = re.sub(r'<img[^>]*>(?:</img>)?', '', body, flags=re.IGNORECASE)
-                rec["Body"] = body.strip()
+                rec["Body"] = new_body.strip()
     return records
 
+def filter_by_parent_condition(sf_source, feeditems, obj_name, condition):
+    """Client-side fallback: keep FeedItems whose parent satisfies condition, checked in chunked SOQL."""
+    parent_ids = {fi["ParentId"] for fi in feeditems if fi.get("ParentId")}
+    valid_parents = set()
+    for records in query_in_chunks(sf_source, f"SELECT Id FROM {obj_name} WHERE Id IN ({{ids}}) AND {condition}", parent_ids):
+        valid_parents.update({p["Id"] for p in records})
+
+    return [fi for fi in feeditems if fi["ParentId"] in valid_parents]
+
 def fetch_filtered_feeditems(sf_source, sf_target, obj_name, condition):
-    """Fetch FeedItems first, then filter based on parent records."""
+    """Fetch FeedItems whose parent matches condition; Salesforce filters via a semi-join."""
     try:
-        # Step 1: Fetch all FeedItems for given object type (Parent.Type)
         soql = f"""
             SELECT Id, ParentId, Body, LinkUrl, Type, RelatedRecordId,
                    CreatedById, CreatedDate, IsRichText, Visibility, Title
             FROM FeedItem
             WHERE  Parent.Type = '{obj_name}'
         """
-        feeditems = sf_source.query_all(soql)["records"]
-        print(f"Fetched FeedItems for {obj_name}: {len(feeditems)}")
+        if not condition:
+            feeditems = sf_source.query_all(soql)["records"]
+        else:
+            try:
+                # Step 1: Let the server apply the parent condition
+                feeditems = sf_source.query_all(
+                    soql + f" AND ParentId IN (SELECT Id FROM {obj_name} WHERE {condition})"
+                )["records"]
+            except Exception as e:
+                # Step 1b: Semi-join rejected (e.g. condition not allowed in a subquery)
+                logging.warning(f"Semi-join rejected for {obj_name}, filtering parents client-side: {e}")
+                feeditems = filter_by_parent_condition(
+                    sf_source, sf_source.query_all(soql)["records"], obj_name, condition
+                )
 
         if not feeditems:
             print(f"⚠️ No FeedItems found for {obj_name}")
             return []
 
-        parent_ids = {fi["ParentId"] for fi in feeditems if fi.get("ParentId")}
-        if not parent_ids:
-            return []
-
-        # Step 2: Fetch parent records with condition
-        parent_list = list(parent_ids)
-        valid_parents = set()
-
-        for i in range(0, len(parent_list), 2000):
-            ids_str = ",".join([f"'{pid}'" for pid in parent_list[i:i+2000]])
-            parent_soql = f"SELECT Id FROM {obj_name} WHERE Id IN ({ids_str})"
-            if condition:
-                parent_soql += f" AND {condition}"
-
-            parent_records = sf_source.query_all(parent_soql)["records"]
-            valid_parents.update({p["Id"] for p in parent_records})
-
-        # Step 3: Filter feeditems whose ParentId is valid
-        filtered_feeditems = [fi for fi in feeditems if fi["ParentId"] in valid_parents]
-
-        # Step 4: Map RelatedRecordId if image is in Body
-        filtered_feeditems = related_recordid_mapping(sf_source, sf_target, filtered_feeditems)
+        # Step 2: Map RelatedRecordId if image is in Body
+        filtered_feeditems = related_recordid_mapping(sf_source, sf_target, feeditems)
 
         print(f"FeedItems retained for {obj_name} after parent filtering: {len(filtered_feeditems)}")
         logging.info(f"{len(filtered_feeditems)} FeedItems retained for {obj_name}")
@@ -148,136 +137,189 @@ def fetch_filtered_feeditems(sf_source, sf_target, obj_name, condition):
 
 
 
-def migrate_feeditems(sf_source, sf_target):
-    """Main migration loop"""
-    all_feeditems = []
-    all_mappings = {}
-    createdBy_mappings = {}
-    relatedId_mappings = {}
-
-    for obj_name, condition in OBJECT_CONDITIONS.items():
-        logging.info(f"Processing object: {obj_name}")
-
-        # Step 1: Fetch FeedItems for this object
-        relevant_feeditems = fetch_filtered_feeditems(sf_source,sf_target, obj_name, condition)
-        if not relevant_feeditems:
+def insert_feeditems(sf_target, target_feeditems):
+    """
+    POST one batch (<= 200 records) to the sObject Collections endpoint.
+    Returns (results, None) with one {"id", "success", "errors"} dict per record,
+    or (None, error) if the request itself failed.
+    """
+    try:
+        results = sf_target.restful(
+            "composite/sobjects", method="POST",
+            json={"allOrNone": False, "records": [fi for *_, fi in target_feeditems]}
+        )
+        return results, None
+    except Exception as e:
+        return None, str(e)
+
+
+def process_object(sf_source, sf_target, obj_name, condition):
+    """Fetch one object's FeedItems plus its ParentId, CreatedById and RelatedRecordId mappings"""
+    logging.info(f"Processing object: {obj_name}")
+
+    # Step 1: Fetch FeedItems for this object
+    relevant_feeditems = fetch_filtered_feeditems(sf_source,sf_target, obj_name, condition)
+    if not relevant_feeditems:
+        return [], {}, {}, {}
+
+    # Step 2: Collect parent, creator and related IDs in one pass
+    parent_ids, createdBy_ids, related_ids = set(), set(), set()
+    for fi in relevant_feeditems:
+        parent_ids.add(fi["ParentId"])
+        createdBy_ids.add(fi["CreatedById"])
+        if fi.get("RelatedRecordId"):
+            related_ids.add(fi["RelatedRecordId"])
+
+    # Step 3: Build mapping for this object
+    target_mapping = fetch_target_mappings(sf_target, obj_name, parent_ids, IN_CHUNK_SIZE)
+
+    # Step 4: Build CreatedById mappings
+    createdBy_mappings = fetch_createdByIds(sf_target, createdBy_ids)
+
+    # Step 5: Map RelatedRecordIds (ContentVersion) for this object
+    relatedId_mappings = fetch_target_mappings(sf_target, "ContentVersion", related_ids, IN_CHUNK_SIZE)
+
+    return relevant_feeditems, target_mapping, createdBy_mappings, relatedId_mappings
+
+
+def build_batches(feeditems, parent_mapping, createdBy_mappings, relatedId_mappings, writer):
+    """
+    Yield lists of up to BATCH_SIZE (src_id, src_parent, tgt_parent, payload) tuples.
+    Records that cannot be migrated are written to writer as they are seen.
+    """
+    target_feeditems = []
+    for record in feeditems:
+        src_parent = record.get("ParentId")
+        tgt_parent = parent_mapping.get(src_parent)
+        tgt_createdBy = createdBy_mappings.get(record.get("CreatedById"))
+
+        feed_body = record.get("Body") or ""
+
+        # 🔹 Skip if no parent mapping OR no valid body
+        if not tgt_parent or _SKIP_BODY_RE.search(feed_body):
+            status = "Skipped - No Parent Mapping" if not tgt_parent else "Skipped - Invalid Body"
+            writer.writerow({
+                "Source_FeedItem_Id": record["Id"],
+                "Target_FeedItem_Id": "",
+                "Source_Parent_Id": src_parent,
+                "Target_Parent_Id": tgt_parent or "",
+                "Status": status
+            })
             continue
-        
-        all_feeditems.extend(relevant_feeditems)
-
-        # Step 2: Collect parent IDs
-        parent_ids = {fi["ParentId"] for fi in relevant_feeditems}
-        
-        # Step 3: Build mapping for this object
-        target_mapping = fetch_target_mappings(sf_target, obj_name, parent_ids, BATCH_SIZE)
-        all_mappings.update(target_mapping)
-
-        # Step 4: Build CreatedById mappings
-        createdBy_ids = {fi["CreatedById"] for fi in relevant_feeditems}
-        createdBy_mappings = fetch_createdByIds(sf_target, createdBy_ids)
-
-        
-        related_ids = {fi["RelatedRecordId"] for fi in relevant_feeditems}
-        relatedId_mappings = fetch_target_mappings(sf_target, "ContentVersion", related_ids, BATCH_SIZE)
-        
-
-    logging.info(f"Total FeedItems collected: {len(all_feeditems)}")
-    logging.info(f"Total ParentId mappings built: {len(all_mappings)}")
-
-    print(f"Total FeedItems collected: {len(all_feeditems)}")
-
-    # Step 4: Insert into Target Org
-    results = []
-    for i in range(0, len(all_feeditems), BATCH_SIZE):
-        chunk = all_feeditems[i:i + BATCH_SIZE]
-        target_feeditems = []
-
-        for record in chunk:
-            src_parent = record.get("ParentId")
-            tgt_parent = all_mappings.get(src_parent)
-            tgt_createdBy = createdBy_mappings.get(record.get("CreatedById"))
-
-            feed_body = record.get("Body") or ""
-
-            # 🔹 Skip if no parent mapping OR no valid body
-            if not tgt_parent or "status changed to" in feed_body.lower():
-                status = "Skipped - No Parent Mapping" if not tgt_parent else "Skipped - Invalid Body"
-                results.append({
-                    "Source_FeedItem_Id": record["Id"],
-                    "Target_FeedItem_Id": "",
-                    "Source_Parent_Id": src_parent,
-                    "Target_Parent_Id": tgt_parent or "",
-                    "Status": status
-                })
+
+        # ✅ Build feed item only if valid
+        new_feeditem = {
+            "attributes": {"type": "FeedItem"},
+            "ParentId": tgt_parent,
+            "Body": record.get("Body"),
+            "LinkUrl": record.get("LinkUrl"),
+            "CreatedById": tgt_createdBy,
+            "CreatedDate": record.get("CreatedDate"),
+            "IsRichText": record.get("IsRichText"),
+            "Visibility": record.get("Visibility"),
+            "Title": record.get("Title"),
+        }
+
+        # Map RelatedRecordId if available
+        if record.get("RelatedRecordId") and record["RelatedRecordId"] in relatedId_mappings:
+            new_feeditem["RelatedRecordId"] = relatedId_mappings[record["RelatedRecordId"]]
+
+        target_feeditems.append((record["Id"], src_parent, tgt_parent, new_feeditem))
+        if len(target_feeditems) == BATCH_SIZE:
+            yield target_feeditems
+            target_feeditems = []
+
+    if target_feeditems:
+        yield target_feeditems
+
+
+def write_batch_results(writer, batch_no, target_feeditems, future):
+    """Wait for one insert batch and write a result row per record."""
+    insert_results, error = future.result()
+    if error is not None:
+        logging.error(f"Batch {batch_no} failed: {error}")
+        for src_id, src_parent, tgt_parent, _ in target_feeditems:
+            writer.writerow({
+                "Source_FeedItem_Id": src_id,
+                "Target_FeedItem_Id": "",
+                "Source_Parent_Id": src_parent,
+                "Target_Parent_Id": tgt_parent,
+                "Status": f"Failed: {error}"
+            })
+        return
+
+    ok = 0
+    for (src_id, src_parent, tgt_parent, _), ins_res in zip(target_feeditems, insert_results):
+        if ins_res["success"]:
+            ok += 1
+            logging.debug("Inserted FeedItem %s as %s", src_id, ins_res.get("id"))
+            writer.writerow({
+                "Source_FeedItem_Id": src_id,
+                "Target_FeedItem_Id": ins_res.get("id"),
+                "Source_Parent_Id": src_parent,
+                "Target_Parent_Id": tgt_parent,
+                "Status": "Success"
+            })
+        else:
+            logging.error(f"FeedItem {src_id} failed: {ins_res['errors']}")
+            writer.writerow({
+                "Source_FeedItem_Id": src_id,
+                "Target_FeedItem_Id": "",
+                "Source_Parent_Id": src_parent,
+                "Target_Parent_Id": tgt_parent,
+                "Status": f"Failed: {ins_res.get('errors')}"
+            })
+    summary = f"Batch {batch_no}: {ok} inserted / {len(insert_results) - ok} failed"
+    print(summary)
+    logging.info(summary)
+
+
+def migrate_feeditems(sf_source, sf_target, writer):
+    """
+    Main migration loop. Each object's FeedItems are mapped and inserted as soon as
+    they are fetched and then dropped. At most OBJECT_WORKERS objects are being
+    fetched or waiting, plus the one being inserted, and at most INSERT_WINDOW
+    batches are in flight; result rows are streamed to writer.
+    """
+    total = 0
+    batch_no = 0
+    pending = deque()  # (batch_no, target_feeditems, future) in submission order
+
+    with ThreadPoolExecutor(max_workers=OBJECT_WORKERS) as obj_ex, \
+         ThreadPoolExecutor(max_workers=INSERT_WORKERS) as insert_ex:
+        # Objects are fetched side by side but consumed here in OBJECT_CONDITIONS order;
+        # the next object is only submitted when one is taken off the window
+        objects = iter(OBJECT_CONDITIONS.items())
+        def submit_next():
+            for obj_name, condition in objects:
+                object_futures.append(obj_ex.submit(process_object, sf_source, sf_target, obj_name, condition))
+                return
+
+        object_futures = deque()
+        for _ in range(OBJECT_WORKERS):
+            submit_next()
+        while object_futures:
+            future = object_futures.popleft()
+            submit_next()
+            feeditems, parent_mapping, createdBy_mappings, relatedId_mappings = future.result()
+            del future
+            if not feeditems:
                 continue
+            total += len(feeditems)
 
-            # ✅ Build feed item only if valid
-            new_feeditem = {
-                "ParentId": tgt_parent,
-                "Body": record.get("Body"),
-                "LinkUrl": record.get("LinkUrl"),
-                "CreatedById": tgt_createdBy,
-                "CreatedDate": record.get("CreatedDate"),
-                "IsRichText": record.get("IsRichText"),
-                "Visibility": record.get("Visibility"),
-                "Title": record.get("Title"),
-            }
-
-            
-            # Map RelatedRecordId if available
-            if record.get("RelatedRecordId") and record["RelatedRecordId"] in relatedId_mappings:
-                new_feeditem["RelatedRecordId"] = relatedId_mappings[record["RelatedRecordId"]]
-
-            target_feeditems.append((record["Id"], src_parent, tgt_parent, new_feeditem))
-        
-            
-        if not target_feeditems:
-            continue
+            # Keep at most INSERT_WINDOW batches in flight; write results oldest first
+            for target_feeditems in build_batches(feeditems, parent_mapping, createdBy_mappings, relatedId_mappings, writer):
+                batch_no += 1
+                pending.append((batch_no, target_feeditems, insert_ex.submit(insert_feeditems, sf_target, target_feeditems)))
+                if len(pending) >= INSERT_WINDOW:
+                    write_batch_results(writer, *pending.popleft())
+            del feeditems, parent_mapping, createdBy_mappings, relatedId_mappings
 
-        try:
-            print("Total FeedItems for insertion: ",len(target_feeditems))
-            insert_results = sf_target.bulk.FeedItem.insert([fi for *_, fi in target_feeditems])
-            print(f"Total FeedItems Inserted into Target: {len(insert_results)}")
-            for (src_id, src_parent, tgt_parent, _), ins_res in zip(target_feeditems, insert_results):
-                if ins_res["success"]:
-                    print(f"Success : {ins_res["success"]} >> {ins_res.get("id")} for Source Id: {src_id}")
-                    results.append({
-                        "Source_FeedItem_Id": src_id,
-                        "Target_FeedItem_Id": ins_res.get("id"),
-                        "Source_Parent_Id": src_parent,
-                        "Target_Parent_Id": tgt_parent,
-                        "Status": "Success"
-                    })
-                else:
-                    print(f"errors : {ins_res["errors"]} for Source Id: {src_id}")
-                    results.append({
-                        "Source_FeedItem_Id": src_id,
-                        "Target_FeedItem_Id": "",
-                        "Source_Parent_Id": src_parent,
-                        "Target_Parent_Id": tgt_parent,
-                        "Status": f"Failed: {ins_res.get('errors')}"
-                    })
-        except Exception as e:
-            for src_id, src_parent, tgt_parent, _ in target_feeditems:
-                results.append({
-                    "Source_FeedItem_Id": src_id,
-                    "Target_FeedItem_Id": "",
-                    "Source_Parent_Id": src_parent,
-                    "Target_Parent_Id": tgt_parent,
-                    "Status": f"Failed: {str(e)}"
-                })
-
-    return results
-
-
-
-def write_results(results):
-    """Save results to CSV"""
-    keys = ["Source_FeedItem_Id", "Target_FeedItem_Id", "Source_Parent_Id", "Target_Parent_Id", "Status"]
-    with open(RESULT_FILE, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=keys)
-        writer.writeheader()
-        writer.writerows(results)
+        while pending:
+            write_batch_results(writer, *pending.popleft())
+
+    logging.info(f"Total FeedItems collected: {total}")
+    print(f"Total FeedItems collected: {total}")
 
 
 
@@ -287,9 +329,12 @@ def main():
     sf_source = connect_salesforce(SF_SOURCE)
     sf_target = connect_salesforce(SF_TARGET)
 
-    results = migrate_feeditems(sf_source, sf_target)
-
-    write_results(results)
+    # Results are written as they are produced rather than collected in memory
+    keys = ["Source_FeedItem_Id", "Target_FeedItem_Id", "Source_Parent_Id", "Target_Parent_Id", "Status"]
+    with open(RESULT_FILE, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        writer = csv.DictWriter(f, fieldnames=keys)
+        writer.writeheader()
+        migrate_feeditems(sf_source, sf_target, writer)
 
     logging.info("=== FeedItem Migration Completed ===")
 
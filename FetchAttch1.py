@@ -1,6 +1,8 @@
 import os
-import pandas as pd
+import csv
 import logging
+from collections import defaultdict
+from itertools import islice
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
 from mappings import fetch_target_mappings,FILES_DIR
@@ -37,7 +39,10 @@ def fetch_all_attachments(sf):
     return results
 
 def fetch_filtered_attachments(sf, object_name, condition):
-    """Fetch only attachments whose parent meets the object condition."""
+    """
+    Yield attachments whose parent meets the object condition.
+    Records are streamed page by page (queryMore) instead of loaded as one list.
+    """
     if not condition:
         # No condition — fetch all attachments for this object type
         soql = f"""
@@ -54,9 +59,45 @@ def fetch_filtered_attachments(sf, object_name, condition):
             )
         """
     print("soql: ", soql)
-    results = sf.query_all(soql)["records"]
-    logging.info(f"Fetched {len(results)} attachments for {object_name} with condition: {condition}")
-    return results
+    count = 0
+    for rec in sf.query_all_iter(soql):
+        count += 1
+        yield rec
+    logging.info(f"Fetched {count} attachments for {object_name} with condition: {condition}")
+
+def fetch_unconditioned_attachments(sf, object_names):
+    """
+    Yield attachments for every object without a condition from a single query.
+    Parent.Type is selected so each record can be routed back to its object locally.
+    """
+    types_str = ",".join(f"'{obj.strip()}'" for obj in object_names)
+    soql = f"""
+        SELECT Id, ParentId, Parent.Type
+        FROM Attachment
+        WHERE CreatedDate >= LAST_N_MONTHS:24 AND Parent.Type IN ({types_str})
+    """
+    print("soql: ", soql)
+    count = 0
+    for rec in sf.query_all_iter(soql):
+        count += 1
+        yield rec
+    logging.info(f"Fetched {count} attachments for {', '.join(object_names)} in one query")
+
+
+def write_mappings(writer, sf_target, obj_name, attachments):
+    """Map one batch of an object's attachments to target parents and write their rows."""
+    # Extract parent IDs for mapping
+    parent_ids = {att["ParentId"] for att in attachments}
+
+    # Get mapping for target org (parents seen in earlier batches come from the cache)
+    target_mapping = fetch_target_mappings(sf_target, obj_name, parent_ids, BATCH_SIZE)
+
+    writer.writerows({
+        "ParentObject": obj_name,
+        "AttachmentId": att["Id"],
+        "SourceParentId": att["ParentId"],
+        "TargetParentId": target_mapping.get(att["ParentId"], "")
+    } for att in attachments)
 
 
 def filter_parent_ids_by_conditions(sf, object_name, parent_ids, condition):
@@ -71,38 +112,42 @@ def main():
     sf_source = connect_salesforce(SF_SOURCE)
     sf_target = connect_salesforce(SF_TARGET)
 
-    all_mappings = []
-
-    for obj_name, condition in OBJECT_CONDITIONS.items():
-        logging.info(f"Processing object: {obj_name}")
-        
-        # Fetch attachments for this object that meet the condition
-        relevant_attachments = fetch_filtered_attachments(sf_source, obj_name, condition)
-        if not relevant_attachments:
-            continue
-
-        # Extract parent IDs for mapping
-        parent_ids = {att["ParentId"] for att in relevant_attachments}
-
-        # Get mapping for target org
-        target_mapping = fetch_target_mappings(sf_target, obj_name, parent_ids, BATCH_SIZE)
-
-        for att in relevant_attachments:
-            src_parent = att["ParentId"]
-            tgt_parent = target_mapping.get(src_parent, "")
-            all_mappings.append({
-                "ParentObject": obj_name,
-                "AttachmentId": att["Id"],
-                "SourceParentId": src_parent,
-                "TargetParentId": tgt_parent
-            })
-
+    # Rows are written per object as they are mapped instead of building one DataFrame at the end
+    keys = ["ParentObject", "AttachmentId", "SourceParentId", "TargetParentId"]
+    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8-sig", buffering=1 << 20) as f:
+        writer = csv.DictWriter(f, fieldnames=keys)
+        writer.writeheader()
+
+        # Objects with a condition need their own semi-join query
+        for obj_name, condition in OBJECT_CONDITIONS.items():
+            if not condition:
+                continue
+            logging.info(f"Processing object: {obj_name}")
+
+            # Stream attachments for this object that meet the condition, BATCH_SIZE at a time
+            attachments = fetch_filtered_attachments(sf_source, obj_name, condition)
+            while relevant_attachments := list(islice(attachments, BATCH_SIZE)):
+                write_mappings(writer, sf_target, obj_name, relevant_attachments)
+
+        # Objects without a condition share one query and are split by Parent.Type
+        unconditioned = [obj for obj, condition in OBJECT_CONDITIONS.items() if not condition]
+        if unconditioned:
+            logging.info(f"Processing objects: {', '.join(unconditioned)}")
+            by_type = {obj.strip(): obj for obj in unconditioned}
+            attachments = fetch_unconditioned_attachments(sf_source, unconditioned)
+            while batch := list(islice(attachments, BATCH_SIZE)):
+                grouped = defaultdict(list)
+                for att in batch:
+                    grouped[by_type.get((att.get("Parent") or {}).get("Type"))].append(att)
+                grouped.pop(None, None)
+                for obj_name, relevant_attachments in grouped.items():
+                    write_mappings(writer, sf_target, obj_name, relevant_attachments)
+
+    # import pandas as pd  # only needed for the Excel export
     # df = pd.DataFrame(all_mappings)
     # df.to_excel(OUTPUT_FILE, index=False)
     # logging.info(f"Mapping saved to {OUTPUT_FILE}")
 
-    df = pd.DataFrame(all_mappings)
-    df.to_csv(OUTPUT_FILE, index=False, encoding="utf-8-sig")  # ← CSV export
     logging.info(f"Mapping saved to {OUTPUT_FILE}")
 
 
@@ -2,11 +2,12 @@ import os
 import pandas as pd
 import base64
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from Auth_Cred.config import SF_SOURCE, SF_TARGET   # ← imported instead of redefining
 from Auth_Cred.auth import connect_salesforce                     # ← imported instead of redefining
-from mappings import FILES_DIR
+from mappings import query_in_chunks, FILES_DIR
 BATCH_LOG_INTERVAL = 50  # Log after every 50 uploads
+MAX_WORKERS = 10  # attachments downloaded/uploaded concurrently
 
 LOG_FILE = os.path.join(FILES_DIR, "migration.log")
 MAPPING_FILE = os.path.join(FILES_DIR, "parent_id_mapping.csv")
@@ -15,13 +16,24 @@ MAPPING_FILE = os.path.join(FILES_DIR, "parent_id_mapping.csv")
 logging.basicConfig(filename=LOG_FILE,level=logging.INFO,format="%(asctime)s - %(message)s")
 
 
+def fetch_attachment_names(sf, att_ids):
+    """Return {AttachmentId: Name} for the source attachments, looked up in chunked SOQL."""
+    names = {}
+    for records in query_in_chunks(sf, "SELECT Id, Name FROM Attachment WHERE Id IN ({ids})", att_ids):
+        for rec in records:
+            names[rec["Id"]] = rec["Name"]
+    return names
+
+
 def download_attachment(sf, att_id):
-    """Download attachment binary from source"""
+    """Download attachment binary from source (over the connection's pooled keep-alive session)"""
     url = f"{sf.base_url}sobjects/Attachment/{att_id}/Body"
     headers = {"Authorization": f"Bearer {sf.session_id}"}
-    response = requests.get(url, headers=headers)
+    response = sf.session.get(url, headers=headers, timeout=300)
     if response.status_code == 200:
-        return base64.b64encode(response.content).decode("utf-8")
+        encoded = base64.b64encode(response.content)
+        del response  # free the raw body before the str copy; peak stays ~2.7x instead of ~3.7x file size
+        return encoded.decode("ascii")
     else:
         logging.error(f"Failed to download {att_id}: {response.status_code} {response.text}")
         return None
@@ -42,45 +54,60 @@ def migrate_attachment(sf_target, parent_id, name, body_base64):
         return None
 
 
+def process_attachment(sf_source, sf_target, att_names, attachment_id, target_parent_id):
+    """Copy one attachment to its target parent. Returns True on success."""
+    try:
+        att_name = att_names.get(attachment_id)
+        if att_name is None:
+            raise LookupError("attachment not found in source org")
+        body_base64 = download_attachment(sf_source, attachment_id)
+        if not body_base64:
+            return False
+        return migrate_attachment(sf_target, target_parent_id, att_name, body_base64) is not None
+
+    except Exception as e:
+        logging.error(f"Error processing attachment {attachment_id}: {e}")
+        return False
+
+
 def main():
     # Step 1: Connect to both orgs
     sf_source = connect_salesforce(SF_SOURCE)
     sf_target = connect_salesforce(SF_TARGET)
 
     # Step 2: Read mapping file
-    df = pd.read_csv(MAPPING_FILE)
+    # Only the two Id columns are needed; read them as plain strings (no NaN/float inference)
+    df = pd.read_csv(
+        MAPPING_FILE,
+        usecols=["AttachmentId", "TargetParentId"],
+        dtype=str,
+        keep_default_na=False,
+        encoding="utf-8-sig",
+    )
+
+    # Skip rows whose target parent is missing
+    df = df[df["TargetParentId"].str.strip().ne("")]
+
+    # Step 3: Look up all attachment names up front instead of one GET per attachment
+    att_names = fetch_attachment_names(sf_source, df["AttachmentId"].tolist())
 
     success_count = 0
     fail_count = 0
 
-    for index, row in df.iterrows():
-        attachment_id = row["AttachmentId"]
-        target_parent_id = row["TargetParentId"]
-
-        # Skip if target parent missing
-        if pd.isna(target_parent_id) or not str(target_parent_id).strip():
-            continue
-
-        try:
-            att_record = sf_source.Attachment.get(attachment_id)
-            att_name = att_record["Name"]
-            body_base64 = download_attachment(sf_source, attachment_id)
-
-            if body_base64:
-                new_att_id = migrate_attachment(sf_target, target_parent_id, att_name, body_base64)
-                if new_att_id:
-                    success_count += 1
-                else:
-                    fail_count += 1
+    # Step 4: Each attachment is a download + upload round trip; run them side by side
+    def _process(pair):
+        return process_attachment(sf_source, sf_target, att_names, *pair)
+
+    pairs = zip(df["AttachmentId"], df["TargetParentId"])
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        for ok in ex.map(_process, pairs):
+            if ok:
+                success_count += 1
             else:
                 fail_count += 1
 
-        except Exception as e:
-            logging.error(f"Error processing attachment {attachment_id}: {e}")
-            fail_count += 1
-
-        if (success_count + fail_count) % BATCH_LOG_INTERVAL == 0:
-            logging.info(f"Processed {success_count + fail_count} attachments: Success={success_count}, Fail={fail_count}")
+            if (success_count + fail_count) % BATCH_LOG_INTERVAL == 0:
+                logging.info(f"Processed {success_count + fail_count} attachments: Success={success_count}, Fail={fail_count}")
 
     logging.info(f"Migration complete. Success={success_count}, Fail={fail_count}")
 
@@ -11,18 +11,20 @@ import os
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
 from activity_config import ACTIVITY_CONFIG, OBJECT_CONDITIONS
-from mappings import fetch_target_mappings, fetch_service_appointment_ids,FILES_DIR
+from mappings import fetch_target_mappings, fetch_service_appointment_ids,query_in_chunks,FILES_DIR
 
 task_export = os.path.join(FILES_DIR, "task_export.csv")     
 event_export = os.path.join(FILES_DIR, "event_export.csv")
 
+# The export only needs ids; activity_import2 re-queries the full field list by Id
+EXPORT_FIELDS = ["Id", "WhatId", "WhoId"]
+
 def fetch_activity_records(sf, object_name, fields, condition):
-    """Fetch Task/Event records from source org with conditions."""
+    """Yield Task/Event records from source org with conditions, one queryMore page at a time."""
     field_str = ", ".join(fields)
     query = f"SELECT {field_str}, What.Type FROM {object_name} WHERE {condition}"
     print(f"[DEBUG] Fetching {object_name} records: {query}")
-    results = sf.query_all(query)
-    return results["records"]
+    yield from sf.query_all_iter(query)
 
 
 def filter_parent_ids_by_object(sf, parent_ids, object_name):
@@ -41,33 +43,32 @@ def filter_parent_ids_by_object(sf, parent_ids, object_name):
     if not condition:
         return parent_ids  # no extra filter
 
-    ids_str = ",".join([f"'{pid}'" for pid in parent_ids])
-    soql = f"SELECT Id FROM {object_name} WHERE Id IN ({ids_str}) AND {condition}"
-    print(f"[DEBUG] Filtering {object_name} IDs: {soql}")
-    results = sf.query_all(soql)["records"]
-    return set(r["Id"] for r in results)
+    print(f"[DEBUG] Filtering {len(parent_ids)} {object_name} IDs")
+    filtered_ids = set()
+    soql = f"SELECT Id FROM {object_name} WHERE Id IN ({{ids}}) AND {condition}"
+    for records in query_in_chunks(sf, soql, parent_ids):
+        filtered_ids.update(r["Id"] for r in records)
+    return filtered_ids
 
 
 def export_activity(sf_source, sf_target, object_name, output_file, batch_size=200):
     """Main export function for Task/Event."""
     config = ACTIVITY_CONFIG[object_name]
-    fields = config["fields"]
     condition = config["condition"]
 
-    # Fetch activities
-    activities = fetch_activity_records(sf_source, object_name, fields, condition)
-    print(f"[INFO] Fetched {len(activities)} {object_name} records from source")
-
-    # Collect parent IDs
+    # Stream activities, keeping only (Id, WhatId, WhoId) and collecting parent IDs in the same pass
+    activities = []
     what_ids_by_type = {}
     who_ids = set()
 
-    for rec in activities:
+    for rec in fetch_activity_records(sf_source, object_name, EXPORT_FIELDS, condition):
+        activities.append((rec["Id"], rec.get("WhatId"), rec.get("WhoId")))
         if rec.get("WhatId") and "Type" in rec["What"]:
             obj_type = rec["What"]["Type"]
             what_ids_by_type.setdefault(obj_type, set()).add(rec["WhatId"])
         if rec.get("WhoId"):
             who_ids.add(rec["WhoId"])
+    print(f"[INFO] Fetched {len(activities)} {object_name} records from source")
 
     # Apply OBJECT_CONDITIONS filtering + fetch target mappings
     parent_mappings = {}
@@ -82,25 +83,24 @@ def export_activity(sf_source, sf_target, object_name, output_file, batch_size=2
     if who_ids:
         mapping = fetch_target_mappings(sf_target, "Contact", who_ids, batch_size)
         parent_mappings.update(mapping)
-    print("activities",activities)
-    # Write export CSV
-    with open(output_file, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        header = ["Source_Activity_Id", "Source_WhatId", "Target_WhatId", "Source_WhoId", "Target_WhoId"]
-        writer.writerow(header)
-
-        for rec in activities:
-            src_id = rec["Id"]
-            src_what = rec.get("WhatId")
-            src_who = rec.get("WhoId")
 
+    def export_rows():
+        """Yield one CSV row per activity whose WhatId (if any) has a target mapping."""
+        for src_id, src_what, src_who in activities:
             tgt_what = parent_mappings.get(src_what) if src_what else ""
             tgt_who = parent_mappings.get(src_who) if src_who else ""
 
             if (src_what and not tgt_what):
                 continue
 
-            writer.writerow([src_id, src_what, tgt_what, src_who, tgt_who])
+            yield [src_id, src_what, tgt_what, src_who, tgt_who]
+
+    # Write export CSV; rows are streamed straight from the activity list, no output copy is built
+    with open(output_file, "w", newline="", encoding="utf-8", buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        header = ["Source_Activity_Id", "Source_WhatId", "Target_WhatId", "Source_WhoId", "Target_WhoId"]
+        writer.writerow(header)
+        writer.writerows(export_rows())
 
     print(f"[SUCCESS] Exported {len(activities)} {object_name} records → {output_file}")
 
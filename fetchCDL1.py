@@ -15,13 +15,14 @@ Notes:
 import os
 import csv
 import time
+import random
 import math
 import logging
 from simple_salesforce import Salesforce
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
-from typing import List, Dict, Iterable
-from mappings import FILES_DIR, fetch_service_appointment_ids
+from typing import List, Dict
+from mappings import FILES_DIR, fetch_service_appointment_ids, chunks, soql_list
 
 OUTPUT_CSV = os.path.join(FILES_DIR, "contentdocumentlink_mapping.csv")
 LOG_FILE = os.path.join(FILES_DIR, "contentdocumentlink_mapping.log")
@@ -37,6 +38,7 @@ logging.basicConfig(
 CHUNK_SIZE = 800
 SLEEP_BETWEEN_RETRIES = 2
 MAX_RETRIES = 5
+MAX_RETRY_SLEEP = 30
 
 # === Object Conditions ===
 # OBJECT_CONDITIONS = {
@@ -57,11 +59,6 @@ OBJECT_CONDITIONS = {
 # --------------------------------------------------
 # Helpers
 # --------------------------------------------------
-def chunked(iterable: List[str], n: int) -> Iterable[List[str]]:
-    for i in range(0, len(iterable), n):
-        yield iterable[i:i+n]
-
-
 def safe_query_all(sf: Salesforce, soql: str):
     attempt = 0
     while True:
@@ -73,8 +70,8 @@ def safe_query_all(sf: Salesforce, soql: str):
             if attempt > MAX_RETRIES:
                 logging.error(f"SOQL failed after {MAX_RETRIES} retries. Error: {e}")
                 raise
-            wait = SLEEP_BETWEEN_RETRIES * (2 ** (attempt - 1))
-            logging.warning(f"Query failed (attempt {attempt}/{MAX_RETRIES}). Retrying in {wait}s. Error: {e}")
+            wait = min(MAX_RETRY_SLEEP, SLEEP_BETWEEN_RETRIES * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5)
+            logging.warning(f"Query failed (attempt {attempt}/{MAX_RETRIES}). Retrying in {wait:.1f}s. Error: {e}")
             time.sleep(wait)
 
 
@@ -98,7 +95,7 @@ def fetch_source_parent_ids(sf_source: Salesforce, obj: str, condition: str) ->
 
 
 def fetch_cdls_for_parent_chunk(sf_source: Salesforce, parent_ids_chunk: List[str]) -> List[Dict]:
-    ids_csv = ",".join(f"'{pid}'" for pid in parent_ids_chunk)
+    ids_csv = soql_list(parent_ids_chunk)
     soql = f"""
         SELECT Id, ContentDocumentId, LinkedEntityId
         FROM ContentDocumentLink
@@ -108,7 +105,7 @@ def fetch_cdls_for_parent_chunk(sf_source: Salesforce, parent_ids_chunk: List[st
 
 
 def build_target_map_for_chunk(sf_target: Salesforce, obj: str, source_parent_chunk: List[str]) -> Dict[str, str]:
-    ids_csv = ",".join(f"'{sid}'" for sid in source_parent_chunk)
+    ids_csv = soql_list(source_parent_chunk)
     soql = f"SELECT Id, Card_Legacy_Id__c FROM {obj} WHERE Card_Legacy_Id__c IN ({ids_csv})"
     records = safe_query_all(sf_target, soql)
     mapping = {}
@@ -127,7 +124,7 @@ def main():
     sf_source = connect_salesforce(SF_SOURCE)
     sf_target = connect_salesforce(SF_TARGET)
 
-    with open(OUTPUT_CSV, mode="w", newline="", encoding="utf-8") as csvfile:
+    with open(OUTPUT_CSV, mode="w", newline="", encoding="utf-8", buffering=1 << 20) as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow([
             "Source_ContentDocumentLink_Id",
@@ -148,7 +145,7 @@ def main():
             chunk_count = math.ceil(len(parent_ids) / CHUNK_SIZE)
             logging.info(f"Processing {len(parent_ids)} parent ids for {obj} in {chunk_count} chunks.")
 
-            for chunk_idx, parent_chunk in enumerate(chunked(parent_ids, CHUNK_SIZE), start=1):
+            for chunk_idx, parent_chunk in enumerate(chunks(parent_ids, CHUNK_SIZE), start=1):
                 logging.info(f"[{obj}] chunk {chunk_idx}/{chunk_count} -> {len(parent_chunk)} parent ids.")
                 print(f"[INFO] [{obj}] chunk {chunk_idx}/{chunk_count} -> {len(parent_chunk)} parent ids.")
 
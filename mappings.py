@@ -1,33 +1,185 @@
 import os
+import re
+import shelve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+QUERY_WORKERS = 8  # concurrent SOQL chunk queries per query_in_chunks call
+# Ids per IN (...) list. query_all sends SOQL in a GET URL (~16k chars max), so
+# 500 quoted 18-char ids (~10k chars) is the largest round number that fits.
+IN_CHUNK_SIZE = 500
+_mapping_cache_lock = threading.Lock()
+_target_id_cache = {}  # {target instance:object:legacy Id: target Id} for this run
+_user_id_cache = {}  # {(sf_instance, legacy user id): target user id} for this run
+_user_id_cache_lock = threading.Lock()
+_cv_cache = {}  # {source instance:ContentDocumentId: latest ContentVersionId} for this run
+_cv_cache_lock = threading.Lock()
+
+def chunks(ids, n):
+    """Yield lists of up to n items from any iterable (list, set, dict view)."""
+    it = iter(ids)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+def soql_list(ids):
+    """Quote and join ids for a SOQL IN (...) clause."""
+    return "'" + "','".join(ids) + "'"
+
+def query_in_chunks(sf, soql, ids, chunk_size=IN_CHUNK_SIZE, query_all=None):
+    """
+    Run one query per chunk_size ids, QUERY_WORKERS at a time, and yield each
+    chunk's records in chunk order.
+    soql is either a template whose {ids} is replaced by the quoted IN list, or a
+    function building the query from one chunk. query_all(sf, soql) -> records
+    replaces sf.query_all for callers with their own retry handling.
+    """
+    build = soql if callable(soql) else (lambda chunk: soql.replace("{ids}", soql_list(chunk)))
+    run = query_all or (lambda sf, q: sf.query_all(q)["records"])
+    with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as ex:
+        yield from ex.map(lambda chunk: run(sf, build(chunk)), chunks(ids, chunk_size))
 
 def fetch_target_mappings(sf, object_name, source_parent_ids, batch_size):
-    """Fetch target org record Ids by Legacy_ID__c"""
+    """
+    Fetch target org record Ids by Legacy_ID__c.
+    Hits are memoized for the run in _target_id_cache, keyed by target
+    instance + object + legacy Id. With USE_MAPPING_CACHE they are also kept
+    on disk (MAPPING_CACHE_FILE), so later runs only query ids not yet mapped.
+    """
     mapping = {}
-    parent_list = list(source_parent_ids)
-    
-    for i in range(0, len(parent_list), batch_size):
-        chunk = parent_list[i:i+batch_size]
-        ids_str = ",".join([f"'{pid}'" for pid in chunk])
-        soql = f"SELECT Id, Card_Legacy_Id__c FROM {object_name} WHERE Card_Legacy_Id__c IN ({ids_str})"
-        
-        results = sf.query_all(soql)["records"]
-        
-        for r in results:
-            mapping[r["Card_Legacy_Id__c"]] = r["Id"]
+    source_parent_ids = {pid for pid in source_parent_ids if pid}  # drop None/"" and duplicates
+    if not source_parent_ids:
+        return mapping
+    key_prefix = f"{sf.sf_instance}:{object_name}:"
+    with _mapping_cache_lock:
+        parent_list = []
+        for pid in source_parent_ids:
+            hit = _target_id_cache.get(key_prefix + pid)
+            if hit:
+                mapping[pid] = hit
+            else:
+                parent_list.append(pid)
+
+        if parent_list and USE_MAPPING_CACHE:
+            with shelve.open(MAPPING_CACHE_FILE) as cache:
+                misses = []
+                for pid in parent_list:
+                    hit = cache.get(key_prefix + pid)
+                    if hit:
+                        mapping[pid] = hit
+                        _target_id_cache[key_prefix + pid] = hit
+                    else:
+                        misses.append(pid)
+            parent_list = misses
+
+    fetched = {}
+    soql = f"SELECT Id, Card_Legacy_Id__c FROM {object_name} WHERE Card_Legacy_Id__c IN ({{ids}})"
+    for records in query_in_chunks(sf, soql, parent_list, batch_size):
+        for r in records:
+            fetched[r["Card_Legacy_Id__c"]] = r["Id"]
+
+    if fetched:
+        with _mapping_cache_lock:
+            _target_id_cache.update((key_prefix + legacy_id, target_id) for legacy_id, target_id in fetched.items())
+            if USE_MAPPING_CACHE:
+                with shelve.open(MAPPING_CACHE_FILE) as cache:
+                    for legacy_id, target_id in fetched.items():
+                        cache[key_prefix + legacy_id] = target_id
+    mapping.update(fetched)
 
     return mapping
 
+def fetch_latest_version_ids(sf, content_doc_ids, batch_size=IN_CHUNK_SIZE):
+    """
+    Return {ContentDocumentId: latest ContentVersionId} for the given documents.
+    Ids are queried batch_size at a time so the IN list stays within SOQL/URL limits.
+    Results are memoized for the run in _cv_cache. With USE_MAPPING_CACHE they are
+    also kept on disk (CV_CACHE_FILE), so re-runs only query documents not seen before.
+    """
+    content_map = {}
+    content_doc_ids = {d for d in content_doc_ids if d}
+    if not content_doc_ids:
+        return content_map
+    key_prefix = f"{sf.sf_instance}:"
+    with _cv_cache_lock:
+        doc_list = []
+        for d in content_doc_ids:
+            hit = _cv_cache.get(key_prefix + d)
+            if hit:
+                content_map[d] = hit
+            else:
+                doc_list.append(d)
+
+        if doc_list and USE_MAPPING_CACHE:
+            with shelve.open(CV_CACHE_FILE) as cache:
+                misses = []
+                for d in doc_list:
+                    hit = cache.get(key_prefix + d)
+                    if hit:
+                        content_map[d] = hit
+                        _cv_cache[key_prefix + d] = hit
+                    else:
+                        misses.append(d)
+            doc_list = misses
+
+    fetched = {}
+    soql = """
+        SELECT ContentDocumentId, Id
+        FROM ContentVersion
+        WHERE ContentDocumentId IN ({ids}) AND IsLatest = true
+    """
+    for records in query_in_chunks(sf, soql, doc_list, batch_size):
+        for v in records:
+            fetched[v["ContentDocumentId"]] = v["Id"]
+
+    if fetched:
+        with _cv_cache_lock:
+            _cv_cache.update((key_prefix + doc_id, ver_id) for doc_id, ver_id in fetched.items())
+            if USE_MAPPING_CACHE:
+                with shelve.open(CV_CACHE_FILE) as cache:
+                    for doc_id, ver_id in fetched.items():
+                        cache[key_prefix + doc_id] = ver_id
+    content_map.update(fetched)
+
+    return content_map
+
+# One <img> tag (any case, with optional </img>); group 1 is the sfdc:// id for lowercase tags
+_IMG_RE = re.compile(r'<(?:img(?=[^>]+src="sfdc://([^"]+)")|(?i:img))[^>]*>(?i:</img>)?')
+
+def strip_images(body):
+    """
+    Remove <img> tags from body in a single regex pass.
+    Returns (sfdc:// ContentDocumentIds in order of appearance, body without the tags).
+    """
+    found = []
+    def _repl(m):
+        if m.group(1):
+            found.append(m.group(1))
+        return ""
+    return found, _IMG_RE.sub(_repl, body)
+
 def fetch_createdByIds(sf_target, createdByIds):
-    """Fetch CreatedById and LastModifiedById mappings from User object."""
+    """
+    Fetch CreatedById and LastModifiedById mappings from User object.
+    Users resolved earlier in the run are served from _user_id_cache.
+    """
     batch_size = 200
     integration_user_id = "0054U00000IESFZQA5"  # Replace with actual integration user Id in target org
     user_mapping = {}
-    id_list = list(createdByIds)
+    instance = sf_target.sf_instance
+    id_list = []
+    with _user_id_cache_lock:
+        for uid in set(createdByIds):
+            if not uid:
+                continue
+            hit = _user_id_cache.get((instance, uid))
+            if hit:
+                user_mapping[uid] = hit
+            else:
+                id_list.append(uid)
     
-    for i in range(0, len(id_list), batch_size):
-        chunk = id_list[i:i+batch_size]
-        ids_str = ",".join([f"'{uid}'" for uid in chunk])
-        soql = f"SELECT Id, Card_Legacy_Id__c FROM User WHERE Card_Legacy_Id__c IN ({ids_str})"
+    for chunk in chunks(id_list, batch_size):
+        soql = f"SELECT Id, Card_Legacy_Id__c FROM User WHERE Card_Legacy_Id__c IN ({soql_list(chunk)})"
         # print(f"[DEBUG] Fetching Users for CreatedById: {soql}")
         results = sf_target.query_all(soql)["records"]
         
@@ -40,6 +192,10 @@ def fetch_createdByIds(sf_target, createdByIds):
             if legacy_id not in user_mapping:
                 user_mapping[legacy_id] = integration_user_id
 
+    with _user_id_cache_lock:
+        for uid in id_list:
+            _user_id_cache[(instance, uid)] = user_mapping[uid]
+
     return user_mapping
 
 def build_owner_mapping(sf_source, sf_target, ownerIds):
@@ -169,3 +325,8 @@ def fetch_service_appointment_ids(sf, sa_ids=None):
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FILES_DIR = os.path.join(BASE_DIR, "files")
 os.makedirs(FILES_DIR, exist_ok=True)
+# Persisting lookups across runs is opt-in: entries are never invalidated, so after target
+# records are re-migrated or new source file versions are uploaded the files must be deleted by hand
+USE_MAPPING_CACHE = False
+MAPPING_CACHE_FILE = os.path.join(FILES_DIR, ".mapping_cache")  # legacy Id -> target Id
+CV_CACHE_FILE = os.path.join(FILES_DIR, ".contentversion_cache")  # ContentDocumentId -> latest ContentVersionId
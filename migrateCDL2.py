@@ -11,11 +11,11 @@ Purpose:
 """
 
 import os
+import io
 import csv
 import math
 import base64
 import logging
-import requests
 from simple_salesforce import Salesforce
 from Auth_Cred.auth import connect_salesforce
 from Auth_Cred.config import SF_SOURCE, SF_TARGET
@@ -35,6 +35,7 @@ logging.basicConfig(
 # Runtime config
 CHUNK_SIZE = 200
 API_VERSION = "v59.0"
+DOWNLOAD_CHUNK_BYTES = 3 * 64 * 1024  # multiple of 3 keeps base64 pieces unpadded
 
 
 # --------------------------------------------------
@@ -75,9 +76,18 @@ def fetch_contentversions(sf: Salesforce, content_doc_ids):
 def download_file_as_base64(sf: Salesforce, version_id: str) -> str:
     """Download file binary from ContentVersion and return base64 string."""
     url = f"https://{sf.sf_instance}/services/data/{API_VERSION}/sobjects/ContentVersion/{version_id}/VersionData"
-    response = requests.get(url, headers={'Authorization': 'Bearer ' + sf.session_id}, stream=True)
+    response = sf.session.get(url, headers={'Authorization': 'Bearer ' + sf.session_id}, stream=True)
     response.raise_for_status()
-    return base64.b64encode(response.content).decode("utf-8")
+    # Encode as the body streams in; carry leftover bytes so each piece is a multiple of 3.
+    buf = io.BytesIO()
+    carry = b""
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+        data = carry + chunk
+        cut = len(data) - len(data) % 3
+        buf.write(base64.b64encode(data[:cut]))
+        carry = data[cut:]
+    buf.write(base64.b64encode(carry))
+    return buf.getvalue().decode("ascii")
 
 
 def create_cdl(sf_target: Salesforce, new_doc_id: str, parent_id: str):
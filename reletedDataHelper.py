@@ -8,7 +8,7 @@ import os
 import pandas as pd
 from typing import Dict, List
 from bs4 import BeautifulSoup
-from mappings import fetch_createdByIds, build_owner_mapping, FILES_DIR
+from mappings import fetch_createdByIds, build_owner_mapping, fetch_latest_version_ids, strip_images, FILES_DIR
 
 
 # === Tunables / Limits ===
@@ -16,6 +16,8 @@ CHUNK_SIZE_API = 200          # Bulk insert batch size (Salesforce limit for sOb
 CHUNK_SIZE_ACTIVITIES = 50    # How many activity IDs to process per outer loop (caller can override)
 SOQL_IN_LIMIT = 1000          # Salesforce 'IN (...)' list size hard limit
 
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+
 
 activity_related_migration = os.path.join(FILES_DIR, "activity_related_migration.csv")
 
@@ -63,10 +65,9 @@ def process_body(body: str) -> str:
         return body
     print("Original body:", body)
     #return re.body(r"<[^>]+>", "", body)
-    return re.sub(r"<[^>]+>", "", body)
+    return _HTML_TAG_RE.sub("", body)
 
 def related_recordid_mapping(sf_source,sf_target,records,object_type):
-    doc_ids = set()
     createdBy_ids = set()
     createdBy_mappings = {}
 
@@ -74,48 +75,31 @@ def related_recordid_mapping(sf_source,sf_target,records,object_type):
     createdBy_mappings = fetch_createdByIds(sf_target, createdBy_ids)
 
 
+    per_rec_scan = []  # strip_images() result per record, reused in step 3
     for rec in records:
         rec["CreatedById"] = createdBy_mappings.get(rec.get("CreatedById"), None)
         if object_type=="Comment":
             body = rec.get("CommentBody") or ""
         else:
             body = rec.get("Body") or ""
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
-        for doc_id in matches:
-            doc_ids.add(doc_id)
+        per_rec_scan.append(strip_images(body))
+    doc_ids = {doc_id for matches, _ in per_rec_scan for doc_id in matches}
 
     if not doc_ids:
         print("⚠️ No <img> tags found in FeedItem bodies, skipping RelatedRecordId mapping")
         return records  # return unchanged
     
     # Step 2: Fetch latest ContentVersion for all unique ContentDocumentIds
-    content_map = {}  # {ContentDocumentId: ContentVersionId}
-
-    if doc_ids:
-        ids_str = ",".join([f"'{d}'" for d in doc_ids])
-        ver_soql = f"""
-            SELECT ContentDocumentId, Id
-            FROM ContentVersion
-            WHERE ContentDocumentId IN ({ids_str}) AND IsLatest = true
-        """
-        ver_q = sf_source.query_all(ver_soql)["records"]
-        
-        for v in ver_q:
-            content_map[v["ContentDocumentId"]] = v["Id"]
+    content_map = fetch_latest_version_ids(sf_source, doc_ids)  # {ContentDocumentId: ContentVersionId}
 
     # Step 3: Update each record with RelatedRecordId if image found
-    for rec in records:
+    for rec, (matches, new_body) in zip(records, per_rec_scan):
         if object_type=="Comment":
-            body = rec.get("CommentBody") or ""
-            new_body = re.sub(r'<img[^>]*>(?:</img>)?', '', body, flags=re.IGNORECASE)
             rec["CommentBody"] = new_body.strip()
 
         else:
-            body = rec.get("Body") or ""
-            new_body = re.sub(r'<img[^>]*>(?:</img>)?', '', body, flags=re.IGNORECASE)
             rec["Body"] = new_body.strip()
             
-        matches = re.findall(r'<img[^>]+src="sfdc://([^"]+)"', body)
         if matches:
             doc_id = matches[0]  # pick first if multiple
             if doc_id in content_map: